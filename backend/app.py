@@ -1,18 +1,28 @@
 import os
+import hmac
 import asyncio
 from pathlib import Path
 from datetime import datetime
 
-from quart import Quart, websocket
+from typing import Optional
+
+from quart import Quart, websocket, request, send_file, abort
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
 
 from pyindigo import logging
 from pyindigo.core import IndigoLogLevel, set_indigo_log_level
 
-from camera_adapter import CameraAdapter
+from camera_adapter import CameraAdapter, FITS_DIR
 import camera_config
-from observation_conditions import get_observation_conditions, run_environmental_conditions_monitor
+from observation_conditions import (
+    get_observation_conditions,
+    run_environmental_conditions_monitor,
+    ObservationConditionsHistory,
+)
+from observation_conditions.environmental import LOGS_DIR
+from archive import ArchiveManager, RetentionPolicy, ThumbnailRenderer, fits_shot_time, night_of, night_files
+from diagnostics import LoopMonitor, SamplingProfiler, DIAGNOSTICS_TOKEN, MIN_PROFILE_INTERVAL
 
 import read_dotenv  # noqa
 
@@ -56,6 +66,19 @@ if os.environ.get("READ_FROM_TTY_CONTROLLER", None) == "yes":
 camera = CameraAdapter(mode=os.environ.get("CAMERA_MODE", None), loop=loop)
 loop.create_task(camera.operate())
 loop.create_task(camera_config.update_on_the_fly())
+archive_manager = ArchiveManager(
+    fits_dir=FITS_DIR,
+    logs_dirs=[LOGS_DIR, PREVIOUS_LOGS_DIR],
+    state_file=ROOT_DIR / "archive_state.json",
+    policy=RetentionPolicy.from_env(),
+    loop=loop,
+)
+camera.on_fits_saved = archive_manager.register_fits
+loop.create_task(archive_manager.operate())
+conditions_history = ObservationConditionsHistory()
+thumbnail_renderer = ThumbnailRenderer(cache_dir=ROOT_DIR / "thumbnails-cache", loop=loop)
+loop_monitor = LoopMonitor(loop)
+profiler = SamplingProfiler()
 
 
 # Quart web app setup
@@ -65,6 +88,12 @@ STATIC_DIR = FRONTENT_BUILD.resolve()
 app = Quart(__name__, static_folder=str(STATIC_DIR), static_url_path="/")
 
 
+@app.before_serving
+async def start_loop_monitor():
+    # not earlier, as blocking module-level setup would be reported as slow callback
+    loop_monitor.start()
+
+
 @app.websocket("/ws/camera-feed")
 async def ws_camera_feed():
     if camera.preview_metadata is not None:
@@ -75,11 +104,137 @@ async def ws_camera_feed():
         await websocket.send(image)
 
 
+@app.route("/api/camera/status")
+async def camera_status():
+    return camera.status_dict()
+
+
 @app.route("/api/observation-conditions")
 async def obs_conditions():
     return get_observation_conditions()
 
 
+def _jsonable(values) -> list:
+    return [None if value != value else value for value in values.tolist()]  # NaN != NaN
+
+
+def _datetime_arg(name: str) -> datetime:
+    try:
+        return datetime.fromisoformat(request.args[name])
+    except (KeyError, ValueError):
+        abort(400)
+
+
+@app.route("/api/observation-conditions/history")
+async def obs_conditions_history():
+    """Measurements in time range, or their mean/min/max/count in time bins if aggregate=<bin size, sec>.
+    All times are UTC, in ISO format in arguments and as unix time in response"""
+    start, end = _datetime_arg("from"), _datetime_arg("to")
+    columns = request.args["columns"].split(",") if "columns" in request.args else None
+    bin_seconds = request.args.get("aggregate", None, type=float)
+    if bin_seconds is not None:
+        if not bin_seconds > 0:  # also rejects NaN
+            abort(400)
+        result = await loop.run_in_executor(None, conditions_history.aggregate, start, end, bin_seconds, columns)
+    else:
+        table = await loop.run_in_executor(None, conditions_history.query, start, end, columns)
+        result = {"timestamp": table.timestamps, **table.columns}
+    return {key: _jsonable(values) for key, values in result.items()}
+
+
+@app.route("/api/observation-conditions/at")
+async def obs_conditions_at():
+    columns = request.args["columns"].split(",") if "columns" in request.args else None
+    values = await loop.run_in_executor(None, conditions_history.value_at, _datetime_arg("time"), columns)
+    return {key: None if value != value else value for key, value in values.items()}
+
+
+def find_archived_image(name: str) -> Optional[Path]:
+    """Blocking, run in executor"""
+    for path in (FITS_DIR / name, FITS_DIR / f"{name}.fz"):  # frame might have been compressed by archive manager
+        if path.exists():
+            return path
+    return None
+
+
+async def archived_image_path(name: str) -> Path:
+    if fits_shot_time(name) is None:  # also guards from paths outside archive
+        abort(404)
+    path = await loop.run_in_executor(None, find_archived_image, name)
+    if path is None:
+        abort(404)
+    return path
+
+
+@app.route("/api/images")
+async def archived_images():
+    night = request.args.get("night", night_of(datetime.utcnow()))
+    try:
+        datetime.strptime(night, r"%Y_%m_%d")
+    except ValueError:
+        abort(400)
+    files = await loop.run_in_executor(None, night_files, FITS_DIR, night)
+    return {"night": night, "images": [file.name for file in files]}
+
+
+@app.route("/api/images/<name>")
+async def archived_image(name: str):
+    # conditional response handles Range headers
+    return await send_file(await archived_image_path(name), mimetype="application/fits", conditional=True)
+
+
+@app.route("/api/images/<name>/thumbnail")
+async def archived_image_thumbnail(name: str):
+    path = await archived_image_path(name)
+    try:
+        thumbnail = await thumbnail_renderer.thumbnail(
+            path,
+            size=request.args.get("size", 256, type=int),
+            stretch=request.args.get("stretch", "minmax"),
+            debayer=request.args.get("debayer", "superpixel"),
+        )
+    except ValueError:
+        abort(400)
+    return thumbnail, 200, {"Content-Type": "image/jpeg", "Cache-Control": "max-age=86400"}
+
+
+def check_diagnostics_token():
+    if not DIAGNOSTICS_TOKEN:
+        abort(404)
+    # header only, query arguments end up in access log
+    auth_header = request.headers.get("Authorization", "")
+    token = auth_header[len("Bearer "):] if auth_header.startswith("Bearer ") else ""
+    if not hmac.compare_digest(token.encode(), DIAGNOSTICS_TOKEN.encode()):
+        abort(403)
+
+
+@app.route("/api/diagnostics/loop")
+async def diagnostics_loop():
+    check_diagnostics_token()
+    return loop_monitor.stats()
+
+
+@app.route("/api/diagnostics/profile")
+async def diagnostics_profile():
+    """Sample stacks for given number of seconds, returns collapsed stacks to be viewed in e.g. speedscope.app"""
+    check_diagnostics_token()
+    seconds = request.args.get("seconds", 10, type=float)
+    interval = request.args.get("interval", 0.005, type=float)
+    threads = request.args.get("threads", "loop")
+    if threads not in {"loop", "all"} or not seconds > 0 or not interval >= MIN_PROFILE_INTERVAL:
+        abort(400)
+    if threads == "loop" and loop_monitor.loop_thread_id is None:  # monitor is started with serving
+        abort(503)
+    thread_ids = [loop_monitor.loop_thread_id] if threads == "loop" else None
+    try:
+        collapsed_stacks = await loop.run_in_executor(None, profiler.profile, seconds, interval, thread_ids)
+    except RuntimeError:
+        abort(409)
+    filename = f"profile_{datetime.utcnow().strftime(r'%Y_%m_%d_%H_%M_%S')}.folded"
+    headers = {"Content-Type": "text/plain", "Content-Disposition": f"attachment; filename={filename}"}
+    return collapsed_stacks, 200, headers
+
+
 @app.route("/", methods=["GET"])
 async def index():
     return await app.send_static_file("index.html")
@@ -0,0 +1,12 @@
+from .retention import ArchiveManager, RetentionPolicy, fits_shot_time, night_of, night_files
+from .thumbnails import ThumbnailRenderer
+
+
+__all__ = [
+    "ArchiveManager",
+    "RetentionPolicy",
+    "ThumbnailRenderer",
+    "fits_shot_time",
+    "night_of",
+    "night_files",
+]
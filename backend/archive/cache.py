@@ -0,0 +1,130 @@
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from typing import List, Optional
+
+import logging
+
+
+class TwoTierLRUCache:
+    """Size-bounded LRU cache for rendered bytes: small memory tier in front of larger on-disk tier.
+
+    Thread-safe; memory tier lookups are cheap enough to be done from the event loop, disk tier
+    lookups and all writes do file I/O and should be done in worker threads. Disk tier index is restored
+    from files left by previous runs on the first disk access, so creating the cache does no I/O."""
+
+    def __init__(self, memory_bytes: int, disk_dir: Path, disk_bytes: int):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_used = 0
+
+        self._disk: "OrderedDict[str, int]" = OrderedDict()  # key -> file size
+        self._disk_used = 0
+        self._disk_index_lock = threading.Lock()  # separate, so that memory tier is available while indexing
+        self._disk_indexed = False
+
+    def _ensure_disk_index(self):
+        """Restore disk tier from previous runs in LRU order, done once in worker thread"""
+        with self._disk_index_lock:
+            if self._disk_indexed:
+                return
+            self.disk_dir.mkdir(exist_ok=True)
+            cached_files = []
+            for file in self.disk_dir.glob("*.bin"):
+                try:
+                    file_stat = file.stat()
+                except OSError:
+                    continue
+                cached_files.append((file_stat.st_mtime, file.stem, file_stat.st_size))
+            with self.lock:
+                for _, key, size in sorted(cached_files):
+                    self._disk[key] = size
+                    self._disk_used += size
+                evicted = self._evict_from_disk()
+            self._delete_files(evicted)
+            self._disk_indexed = True
+
+    def get_from_memory(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            return value
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self.get_from_memory(key)
+        if value is not None:
+            return value
+        self._ensure_disk_index()
+        with self.lock:
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        try:
+            value = self._disk_file(key).read_bytes()
+            os.utime(self._disk_file(key))  # to restore LRU order on restart
+        except OSError:
+            with self.lock:
+                self._forget_on_disk(key)
+            return None
+        self._put_to_memory(key, value)
+        return value
+
+    def put(self, key: str, value: bytes):
+        self._put_to_memory(key, value)
+        self._ensure_disk_index()
+        file = self._disk_file(key)
+        temp_file = file.with_suffix(".tmp")
+        try:
+            temp_file.write_bytes(value)
+            os.replace(temp_file, file)
+        except OSError as e:
+            logging.warning(f"Unable to write cache file {file}, keeping value in memory only. Details: {e}")
+            return
+        with self.lock:
+            self._forget_on_disk(key)
+            self._disk[key] = len(value)
+            self._disk_used += len(value)
+            evicted = self._evict_from_disk()
+        self._delete_files(evicted)
+
+    def _put_to_memory(self, key: str, value: bytes):
+        if len(value) > self.memory_bytes:
+            return
+        with self.lock:
+            if key in self._memory:
+                self._memory_used -= len(self._memory.pop(key))
+            self._memory[key] = value
+            self._memory_used += len(value)
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= len(evicted)
+
+    def _disk_file(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.bin"
+
+    def _forget_on_disk(self, key: str):
+        """Must be called with lock acquired"""
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_used -= size
+
+    def _evict_from_disk(self) -> List[str]:
+        """Must be called with lock acquired. Evicted keys are returned, their files are to be deleted
+        with _delete_files after releasing the lock, so that event loop is not blocked by file I/O"""
+        evicted = []
+        while self._disk_used > self.disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            evicted.append(key)
+        return evicted
+
+    def _delete_files(self, keys: List[str]):
+        for key in keys:
+            self._disk_file(key).unlink(missing_ok=True)
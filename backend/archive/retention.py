@@ -0,0 +1,319 @@
+import os
+import asyncio
+import gzip
+import json
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import logging
+
+import pytz
+
+import utils.fits as fitsutils
+from observation_conditions.celestial import irkutsk
+
+import read_dotenv  # noqa
+
+
+GB = 1024 ** 3
+DAY = 24 * 60 * 60
+
+FITS_NAME_PATTERN = re.compile(r"^\w+?_(\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2})\.fits(\.fz)?$")
+GZIPPED_SUFFIXES = (".tsv", ".log")
+
+
+def _optional_env(name: str, type_: type):
+    value = os.environ.get(name, "").strip()
+    return type_(value) if value else None
+
+
+@dataclass
+class RetentionPolicy:
+    """Archive retention settings, every policy is disabled when set to None (see .env.example)"""
+
+    max_disk_usage_gb: Optional[float] = None
+    min_free_space_gb: Optional[float] = None
+    keep_nights: Optional[int] = None
+    compress_after_days: Optional[float] = None
+    gzip_after_days: Optional[float] = None
+    check_period: float = 60  # sec
+    batch_size: int = 50  # max files compressed in a single pass
+
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        return cls(
+            max_disk_usage_gb=_optional_env("ARCHIVE_MAX_DISK_USAGE_GB", float),
+            min_free_space_gb=_optional_env("ARCHIVE_MIN_FREE_SPACE_GB", float),
+            keep_nights=_optional_env("ARCHIVE_KEEP_NIGHTS", int),
+            compress_after_days=_optional_env("ARCHIVE_COMPRESS_AFTER_DAYS", float),
+            gzip_after_days=_optional_env("ARCHIVE_GZIP_AFTER_DAYS", float),
+            check_period=_optional_env("ARCHIVE_CHECK_PERIOD", float) or cls.check_period,
+            batch_size=_optional_env("ARCHIVE_BATCH_SIZE", int) or cls.batch_size,
+        )
+
+
+def fits_shot_time(name: str) -> Optional[datetime]:
+    """UTC datetime encoded in archived FITS file name, like 'image_2020_10_15_19_21_39.fits[.fz]'"""
+    match = FITS_NAME_PATTERN.match(name)
+    if match is None:
+        return None
+    return datetime.strptime(match.group(1), r"%Y_%m_%d_%H_%M_%S")
+
+
+def night_of(shot_time: datetime) -> str:
+    """Observation night key: local date of the evening the night has started on"""
+    local_time = pytz.utc.localize(shot_time).astimezone(irkutsk)
+    return (local_time - timedelta(hours=12)).strftime(r"%Y_%m_%d")
+
+
+def night_files(fits_dir: Path, night: str) -> List[Path]:
+    """Night's FITS files, found by name only: files of other nights are not stat-ed or opened"""
+    evening_date = datetime.strptime(night, r"%Y_%m_%d")
+    # night spans local evening and morning, which are at most two UTC dates
+    utc_dates = {(evening_date + timedelta(days=offset)).strftime(r"%Y_%m_%d") for offset in (-1, 0, 1)}
+    files = []
+    with os.scandir(fits_dir) as entries:
+        for entry in entries:
+            shot_time = fits_shot_time(entry.name)
+            if shot_time is None or shot_time.strftime(r"%Y_%m_%d") not in utc_dates:
+                continue
+            if night_of(shot_time) == night:
+                files.append(Path(entry.path))
+    return sorted(files)
+
+
+def _lower_thread_priority():
+    """Run archive worker thread with the lowest CPU priority and idle I/O scheduling class (both are per-thread
+    on Linux), so the worker does not compete with the capture. I/O class is set explicitly, as only some
+    I/O schedulers derive it from CPU priority"""
+    try:
+        thread_id = threading.get_native_id()
+        os.setpriority(os.PRIO_PROCESS, thread_id, 19)
+        subprocess.run(["ionice", "-c", "3", "-p", str(thread_id)], check=True, capture_output=True)
+    except (AttributeError, OSError, subprocess.CalledProcessError) as e:
+        logging.info(f"Unable to lower archive worker priority, continuing with default one. Details: {e}")
+
+
+class ArchiveManager:
+    """Incrementally enforces RetentionPolicy on images archive and logs directories.
+
+    Archive inventory (bytes and files per night) is kept in a persistent state file and updated as new
+    frames are registered, so the images directory is fully listed for inventory only once, on the first
+    launch. Afterwards it is listed once per past night to be compressed (the list is reused across batches)
+    and once per night to be deleted, never on every pass. All file operations are run in a single
+    low-priority worker thread, event loop only schedules them."""
+
+    def __init__(
+        self,
+        fits_dir: Path,
+        logs_dirs: Iterable[Path],
+        state_file: Path,
+        policy: RetentionPolicy,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.fits_dir = fits_dir
+        self.logs_dirs = list(logs_dirs)
+        self.state_file = state_file
+        self.policy = policy
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="archive", initializer=_lower_thread_priority
+        )
+        self.nights: Dict[str, Dict] = dict()  # night key -> {"bytes": int, "files": int, "compressed": bool}
+        self._uncompressed_files: Dict[str, List[Path]] = dict()  # night key -> files left, worker thread only
+        self.bootstrapped = False
+        self._state_dirty = False
+
+    async def operate(self):
+        """Main coroutine, to be launched from outside"""
+        state = await self._run_in_worker(self._load_state)
+        if state is not None:
+            for night, stats in state["nights"].items():  # frames might have been registered in the meantime
+                registered = self.nights.get(night, {"bytes": 0, "files": 0, "compressed": True})
+                self.nights[night] = {
+                    "bytes": stats["bytes"] + registered["bytes"],
+                    "files": stats["files"] + registered["files"],
+                    "compressed": stats["compressed"] and registered["compressed"],
+                }
+            self.bootstrapped = state["bootstrapped"]
+        while True:
+            try:
+                if not self.bootstrapped:
+                    self.nights = await self._run_in_worker(self._inventory_fits_dir)
+                    self.bootstrapped = True
+                    self._state_dirty = True
+                    logging.info(f"Archive inventory done: {self._archive_summary()}")
+                await self._enforce_space_limits()
+                await self._compress_oldest_night()
+                await self._gzip_old_logs()
+                if self._state_dirty:
+                    self._state_dirty = False
+                    state_json = json.dumps({"bootstrapped": self.bootstrapped, "nights": self.nights})
+                    await self._run_in_worker(self._save_state, state_json)
+            except Exception:
+                logging.exception("Unexpected error in archive manager, will retry on the next pass")
+            await asyncio.sleep(self.policy.check_period)
+
+    def register_fits(self, path: Path):
+        """Account for newly saved FITS file; is cheap and is called from capture callbacks"""
+        shot_time = fits_shot_time(path.name)
+        if shot_time is None:
+            return
+        night = self.nights.setdefault(night_of(shot_time), {"bytes": 0, "files": 0, "compressed": False})
+        try:
+            night["bytes"] += path.stat().st_size
+        except OSError:
+            return
+        night["files"] += 1
+        night["compressed"] = False
+        self._state_dirty = True
+
+    # policies
+
+    async def _enforce_space_limits(self):
+        current_night = night_of(datetime.utcnow())
+        while True:
+            past_nights = sorted(night for night in self.nights if night != current_night)
+            if not past_nights:
+                if self._space_limit_exceeded(len(self.nights)):
+                    logging.warning("Archive space limits are exceeded, but only current night's frames are left")
+                return
+            if not self._space_limit_exceeded(len(self.nights)):
+                return
+            oldest_night = past_nights[0]
+            removed_files = await self._run_in_worker(self._delete_night, oldest_night)
+            logging.info(f"Archive: night {oldest_night} deleted ({removed_files} files)")
+            del self.nights[oldest_night]
+            self._state_dirty = True
+
+    def _space_limit_exceeded(self, nights_count: int) -> bool:
+        policy = self.policy
+        if policy.keep_nights is not None and nights_count > policy.keep_nights:
+            return True
+        if policy.max_disk_usage_gb is not None:
+            if sum(night["bytes"] for night in self.nights.values()) > policy.max_disk_usage_gb * GB:
+                return True
+        if policy.min_free_space_gb is not None:
+            if shutil.disk_usage(self.fits_dir).free < policy.min_free_space_gb * GB:
+                return True
+        return False
+
+    async def _compress_oldest_night(self):
+        if self.policy.compress_after_days is None:
+            return
+        threshold = night_of(datetime.utcnow() - timedelta(days=self.policy.compress_after_days))
+        pending_nights = sorted(
+            night for night, stats in self.nights.items() if not stats["compressed"] and night < threshold
+        )
+        if not pending_nights:
+            return
+        night = pending_nights[0]
+        bytes_delta, done = await self._run_in_worker(self._compress_night_batch, night, self.policy.batch_size)
+        self.nights[night]["bytes"] += bytes_delta
+        self.nights[night]["compressed"] = done
+        self._state_dirty = True
+        if done:
+            logging.info(f"Archive: night {night} compressed")
+
+    async def _gzip_old_logs(self):
+        if self.policy.gzip_after_days is None:
+            return
+        gzipped = await self._run_in_worker(self._gzip_logs, time.time() - self.policy.gzip_after_days * DAY)
+        if gzipped:
+            logging.info(f"Archive: gzipped {', '.join(gzipped)}")
+
+    # blocking operations, run in worker thread only
+
+    def _run_in_worker(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def _load_state(self) -> Optional[Dict]:
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            logging.info("No archive state file found, archive inventory will be done from scratch")
+        except Exception:
+            logging.exception("Unable to read archive state file, archive inventory will be done from scratch")
+        return None
+
+    def _save_state(self, state_json: str):
+        temp_file = self.state_file.with_suffix(".tmp")
+        with open(temp_file, "w") as f:
+            f.write(state_json)
+        os.replace(temp_file, self.state_file)
+
+    def _inventory_fits_dir(self) -> Dict[str, Dict]:
+        nights = dict()
+        with os.scandir(self.fits_dir) as entries:
+            for entry in entries:
+                shot_time = fits_shot_time(entry.name)
+                if shot_time is None:
+                    continue
+                night = nights.setdefault(night_of(shot_time), {"bytes": 0, "files": 0, "compressed": True})
+                night["bytes"] += entry.stat().st_size
+                night["files"] += 1
+                if not entry.name.endswith(".fz"):
+                    night["compressed"] = False
+        return nights
+
+    def _delete_night(self, night: str) -> int:
+        self._uncompressed_files.pop(night, None)
+        files = night_files(self.fits_dir, night)
+        for file in files:
+            file.unlink(missing_ok=True)
+        return len(files)
+
+    def _compress_night_batch(self, night: str, batch_size: int) -> Tuple[int, bool]:
+        uncompressed = self._uncompressed_files.get(night)
+        if uncompressed is None:  # past night gets no new files, so it is listed once for all batches
+            uncompressed = [file for file in night_files(self.fits_dir, night) if file.suffix == ".fits"]
+        batch, self._uncompressed_files[night] = uncompressed[:batch_size], uncompressed[batch_size:]
+        bytes_delta = 0
+        for file in batch:
+            compressed_file = file.with_suffix(".fits.fz")
+            temp_file = file.with_suffix(".fits.fz.tmp")
+            try:
+                fitsutils.compress_fits(file, temp_file)
+                os.replace(temp_file, compressed_file)
+                bytes_delta += compressed_file.stat().st_size - file.stat().st_size
+                file.unlink()
+            except Exception:
+                logging.exception(f"Unable to compress {file}, leaving it as is")
+                temp_file.unlink(missing_ok=True)
+        done = not self._uncompressed_files[night]
+        if done:
+            del self._uncompressed_files[night]
+        return bytes_delta, done
+
+    def _gzip_logs(self, older_than: float) -> List[str]:
+        gzipped = []
+        for logs_dir in self.logs_dirs:
+            for file in logs_dir.iterdir():
+                if file.suffix not in GZIPPED_SUFFIXES or not file.is_file():
+                    continue
+                file_stat = file.stat()
+                if file_stat.st_mtime > older_than:
+                    continue
+                gzipped_file = file.with_name(file.name + ".gz")
+                temp_file = file.with_name(file.name + ".gz.tmp")
+                with open(file, "rb") as f_in, gzip.open(temp_file, "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.utime(temp_file, (file_stat.st_atime, file_stat.st_mtime))  # keeping file age
+                os.replace(temp_file, gzipped_file)
+                file.unlink()
+                gzipped.append(file.name)
+        return gzipped
+
+    def _archive_summary(self) -> str:
+        total_bytes = sum(night["bytes"] for night in self.nights.values())
+        return f"{len(self.nights)} nights, {total_bytes / GB:.2f} GB"
@@ -0,0 +1,81 @@
+import os
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+from typing import Dict
+
+import utils.fits as fitsutils
+from archive.cache import TwoTierLRUCache
+
+import read_dotenv  # noqa
+
+
+MB = 1024 ** 2
+
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", 2))
+THUMBNAIL_MEMORY_CACHE_MB = float(os.environ.get("THUMBNAIL_MEMORY_CACHE_MB", 64))
+THUMBNAIL_DISK_CACHE_MB = float(os.environ.get("THUMBNAIL_DISK_CACHE_MB", 1024))
+
+MAX_THUMBNAIL_SIZE = 2048
+STRETCH_OPTIONS = ("minmax", "percentile")
+DEBAYER_OPTIONS = ("none", "superpixel", "bilinear")
+
+
+def render_thumbnail(path: Path, size: int, stretch: str, debayer: str = "superpixel") -> bytes:
+    """Render FITS frame as JPEG, fitted into size x size box. Raw Bayer frames are debayered"""
+    image_data, header = fitsutils.read_image(path)
+    image_data = fitsutils.debayered(image_data, header, None if debayer == "none" else debayer)
+    image = fitsutils.frame_to_image(image_data, stretch=stretch)
+    image.thumbnail((size, size))
+    inmem_file = BytesIO()
+    image.save(inmem_file, format="jpeg")
+    return inmem_file.getvalue()
+
+
+class ThumbnailRenderer:
+    """Renders archived frames on demand in worker threads and caches results.
+
+    Cache key includes file's mtime and size, so frames recompressed or rewritten in archive are re-rendered.
+    Concurrent requests for the same thumbnail share single rendering job."""
+
+    def __init__(self, cache_dir: Path, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnails")
+        self.cache = TwoTierLRUCache(
+            memory_bytes=int(THUMBNAIL_MEMORY_CACHE_MB * MB),
+            disk_dir=cache_dir,
+            disk_bytes=int(THUMBNAIL_DISK_CACHE_MB * MB),
+        )
+        self._in_progress: Dict[str, asyncio.Future] = dict()
+
+    async def thumbnail(self, path: Path, size: int, stretch: str = "minmax", debayer: str = "superpixel") -> bytes:
+        if not 0 < size <= MAX_THUMBNAIL_SIZE:
+            raise ValueError(f"Thumbnail size must be between 1 and {MAX_THUMBNAIL_SIZE}, {size} received")
+        if stretch not in STRETCH_OPTIONS:
+            raise ValueError(f"Unknown stretch {stretch}. Options are {', '.join(STRETCH_OPTIONS)}")
+        if debayer not in DEBAYER_OPTIONS:
+            raise ValueError(f"Unknown debayering method {debayer}. Options are {', '.join(DEBAYER_OPTIONS)}")
+        file_stat = await self.loop.run_in_executor(None, path.stat)  # not in self.executor, busy with rendering
+        key = hashlib.sha1(
+            f"{path.name}:{file_stat.st_mtime_ns}:{file_stat.st_size}:{size}:{stretch}:{debayer}".encode()
+        ).hexdigest()
+
+        thumbnail = self.cache.get_from_memory(key)
+        if thumbnail is not None:
+            return thumbnail
+        if key not in self._in_progress:
+            self._in_progress[key] = self.loop.run_in_executor(
+                self.executor, self._get_or_render, key, path, size, stretch, debayer
+            )
+            self._in_progress[key].add_done_callback(lambda _: self._in_progress.pop(key, None))
+        return await asyncio.shield(self._in_progress[key])
+
+    def _get_or_render(self, key: str, path: Path, size: int, stretch: str, debayer: str) -> bytes:
+        thumbnail = self.cache.get(key)
+        if thumbnail is None:
+            thumbnail = render_thumbnail(path, size, stretch, debayer)
+            self.cache.put(key, thumbnail)
+        return thumbnail
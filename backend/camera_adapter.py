@@ -4,7 +4,7 @@ import asyncio
 import time
 from collections import defaultdict
 
-from typing import Callable, Any, Dict
+from typing import Callable, Any, Dict, Optional
 
 from pyindigo import logging
 
@@ -23,7 +23,8 @@ from pyindigo.core.properties.schemas import UserDefinedItem
 from pyindigo.core.enums import IndigoDriverAction, IndigoPropertyState
 
 import utils.fits as fitsutils
-from camera_config import camera_config, ShotType
+from dark_library import DarkLibrary
+from camera_config import camera_config, ShotType, SENSOR_WIDTH, SENSOR_HEIGHT
 from observation_conditions.celestial import all_conditions, localtime_str
 from observation_conditions.environmental import EnvironmentalConditionsReadingProtocol
 
@@ -31,14 +32,24 @@ from observation_conditions.environmental import EnvironmentalConditionsReadingP
 import read_dotenv  # noqa
 
 
-driver = IndigoDriver("indigo_ccd_simulator")
-
 FITS_DIR = Path(__file__).parent.parent / "images"
 FITS_DIR.mkdir(exist_ok=True)
 
 DEBUG_LOCK = os.environ.get("DEBUG_CAMERA_LOCK", "no") == "yes"
 CAMERA_DEVICE_NAME = os.environ.get("CAMERA_DEVICE_NAME", "ZWO ASI120MC-S #0")
 
+# exposure is considered failed if image is not received in (exposure time + margin)
+EXPOSURE_TIMEOUT_MARGIN = float(os.environ.get("EXPOSURE_TIMEOUT_MARGIN", 15))  # sec
+EXPOSURE_RETRIES = int(os.environ.get("EXPOSURE_RETRIES", 2))
+RECONNECT_MAX_DELAY = float(os.environ.get("CAMERA_RECONNECT_MAX_DELAY", 60))  # sec
+CONNECT_TIMEOUT = float(os.environ.get("CAMERA_CONNECT_TIMEOUT", 30))  # sec
+
+
+class CameraStatus:
+    DISCONNECTED = "disconnected"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+
 
 class CameraAdapter:
     """Adapter for pyindigo camera, handling high-level asyncronous operation, configuration, etc
@@ -60,14 +71,23 @@ class CameraAdapter:
         else:
             raise ValueError(f"mode must be 'Real' or 'Simulator' (preferably set in .env file), but {mode} received")
 
-        self.driver = IndigoDriver(driver_name)
-        self.driver.attach()
-        time.sleep(1)
-        self.device = IndigoClient.find_device(device_name)
-        self.device.connect(blocking=True)
+        # actual connection is done asynchronously by _supervise_connection to keep startup non-blocking
+        self.driver_name = driver_name
+        self.device_name = device_name
+        self.driver: Optional[IndigoDriver] = None
+        self.device = None
 
         self.loop = loop
 
+        self.status = CameraStatus.DISCONNECTED
+        self.connected = asyncio.Event()
+        self.connection_lost = asyncio.Event()
+        self.last_error: Optional[str] = None
+        self.reconnects = 0
+        self.last_shot_time: Optional[datetime] = None
+        self._consecutive_device_errors = 0
+        self._applied_properties: Dict[str, Any] = dict()  # property name -> last written items
+
         self.terminal_failure = False
         self.camera_lock = asyncio.Lock()
         self.operation_pending = defaultdict(lambda: False)
@@ -76,30 +96,120 @@ class CameraAdapter:
         self.preview_metadata: dict = None
         self.new_preview_ready = asyncio.Event()
 
+        self.on_fits_saved: Optional[Callable[[Path], None]] = None  # e.g. for archive bookkeeping
+
+        self.dark_library = DarkLibrary()
+        self._dark_scenario_index = 0
+
     async def operate(self):
         """All operations by camera, ready to be run concurrently.
 
         This is the only coroutine that should be launched from outside!"""
         return await asyncio.gather(
+            self._supervise_connection(),
             self._regularly_take_shots(ShotType.PREVIEW, self._preview_generation_callback),
             self._regularly_take_shots(
                 ShotType.SAVE_TO_DISK, self._fits_saving_callback, enabled=self._saving_fits_is_enabled
             ),
             # testing is usually turned off on server (enabled: False in config)
             self._regularly_take_shots(ShotType.TESTING, lambda *args: logging.debug("testing callback run")),
+            self._regularly_take_shots(
+                ShotType.DARKS, self._dark_frame_callback, shot_settings=self._dark_shot_settings, frame_type="DARK"
+            ),
         )
 
+    async def _supervise_connection(self):
+        """Connect to camera in background and reconnect with exponential backoff when it is lost"""
+        delay = 1
+        while True:
+            self.status = CameraStatus.CONNECTING
+            try:
+                # driver calls may hang, in this case executor thread is abandoned
+                await asyncio.wait_for(self.loop.run_in_executor(None, self._connect), timeout=CONNECT_TIMEOUT)
+            except Exception as e:
+                self.status = CameraStatus.DISCONNECTED
+                details = f"timed out after {CONNECT_TIMEOUT} sec" if isinstance(e, asyncio.TimeoutError) else e
+                self.last_error = f"Unable to connect to camera: {details}"
+                logging.warning(f"{self.last_error}, retrying in {delay} sec")
+                await self._disconnect_with_timeout()
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, RECONNECT_MAX_DELAY)
+                continue
+
+            logging.info(f"Camera {self.device_name} connected")
+            delay = 1
+            self.status = CameraStatus.CONNECTED
+            self._consecutive_device_errors = 0
+            self.connection_lost.clear()
+            self.connected.set()
+
+            await self.connection_lost.wait()
+            self.connected.clear()
+            self.status = CameraStatus.DISCONNECTED
+            self.reconnects += 1
+            logging.warning(f"Camera connection lost ({self.last_error}), reconnecting")
+            async with self.camera_lock:  # waiting for pending operations to finish
+                await self._disconnect_with_timeout()
+
+    async def _disconnect_with_timeout(self):
+        try:
+            await asyncio.wait_for(self.loop.run_in_executor(None, self._disconnect), timeout=CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"Camera disconnection timed out after {CONNECT_TIMEOUT} sec, dropping the driver")
+            self.device = None
+            self.driver = None
+
+    def _connect(self):
+        """Blocking connection routine, run in executor"""
+        if self.driver is None:
+            self.driver = IndigoDriver(self.driver_name)
+            self.driver.attach()
+            time.sleep(1)  # giving driver some time to enumerate devices
+        self.device = IndigoClient.find_device(self.device_name)
+        if self.device is None:
+            raise ConnectionError(f"device {self.device_name} not found")
+        self.device.connect(blocking=True)
+        self._applied_properties.clear()  # device state is unknown after (re)connection
+
+    def _disconnect(self):
+        """Blocking disconnection routine, run in executor. Driver is detached too, so that it
+        enumerates devices anew on the next connection (e.g. if camera was physically reconnected)"""
+        try:
+            if self.device is not None:
+                self.device.disconnect()
+            if self.driver is not None:
+                self.driver.detach()
+        except Exception:
+            logging.exception("Error while disconnecting camera, ignoring")
+        self.device = None
+        self.driver = None
+
+    def status_dict(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "device": self.device_name,
+            "last_error": self.last_error,
+            "reconnects": self.reconnects,
+            "last_shot_datetime": localtime_str(self.last_shot_time) if self.last_shot_time else None,
+        }
+
     def _regularly_take_shots(
         self,
         shot_type: ShotType,
         callback: Callable[[Any], None],
         enabled: Callable[[Dict], bool] = None,
+        shot_settings: Callable[[Dict], Dict] = None,
+        frame_type: str = "LIGHT",
     ):
         """Coroutine factory, return coroutine that regularly takes shots with given
-        shot_type (see camconfig.yaml) and callback. Conflicts are resolved with lock"""
+        shot_type (see camconfig.yaml) and callback. Conflicts are resolved with lock.
+
+        Exposure, gain etc are taken from shot type's config entry, unless shot_settings is given"""
 
         if enabled is None:
             enabled = lambda config_entry: config_entry and config_entry["enabled"] is True  # noqa
+        if shot_settings is None:
+            shot_settings = lambda config_entry: config_entry  # noqa
 
         shot_pending = False
 
@@ -108,45 +218,162 @@ class CameraAdapter:
             nonlocal shot_pending  # saving flag in coroutine func's closure
 
             while True:
+                await self.connected.wait()
                 config_entry = camera_config.get(shot_type, None)
-                if enabled(config_entry) and not shot_pending:
-                    shot_pending = True
-                    shot_start_time = time.time()
-                    await self.take_shot(
-                        config_entry["exposure"],
-                        config_entry["gain"],
-                        color_mode=config_entry.get("color_mode", "rgb").lower(),
-                        callback=callback,
-                    )
+                shot_start_time = time.time()
+                try:
+                    if enabled(config_entry) and not shot_pending:
+                        shot_pending = True
+                        settings = shot_settings(config_entry)
+                        await self.take_shot(
+                            settings["exposure"],
+                            settings["gain"],
+                            color_mode=settings.get("color_mode", "rgb").lower(),
+                            binning=settings.get("binning", 1),
+                            roi=settings.get("roi", None),
+                            frame_type=frame_type,
+                            callback=callback,
+                        )
+                except Exception:
+                    # scenario must keep running, e.g. after write error on full disk or device error
+                    logging.exception(f"Error while taking {shot_type} shot")
+                finally:
                     shot_pending = False
-                    shot_duration = time.time() - shot_start_time
-                else:
-                    shot_duration = 0
+                shot_duration = time.time() - shot_start_time
 
                 SLEEP_BETWEEN_PENDING_PROBE = 3  # sec
-                await asyncio.sleep(max(config_entry["period"] - shot_duration, SLEEP_BETWEEN_PENDING_PROBE))
+                period = config_entry["period"] if config_entry else SLEEP_BETWEEN_PENDING_PROBE  # may be missing
+                await asyncio.sleep(max(period - shot_duration, SLEEP_BETWEEN_PENDING_PROBE))
 
         return coro()
 
-    async def take_shot(self, exposure: float, gain: float, color_mode: str, callback: Callable):
-        """Basic camera action, coroutine function that wraps callback-based Indigo stuff."""
-        exposure_result = {"prop": None}
-        exposure_done = asyncio.Event()
-        exposure_done.clear()
+    async def take_shot(
+        self,
+        exposure: float,
+        gain: float,
+        color_mode: str,
+        callback: Callable,
+        binning: int = 1,
+        roi: Optional[Dict[str, int]] = None,
+        frame_type: str = "LIGHT",
+    ):
+        """Basic camera action, coroutine function that wraps callback-based Indigo stuff.
 
-        async def get_exposure_results(action: IndigoDriverAction, prop: IndigoProperty):
-            exposure_result["prop"] = prop
-            exposure_done.set()
+        ROI is a dict with x, y, width and height keys in unbinned sensor pixels, None for full frame.
 
+        Exposure is retried if image is not received in time; if all retries fail, or device operations fail
+        in (1 + EXPOSURE_RETRIES) consecutive shots, camera connection is considered lost and is reestablished
+        by _supervise_connection."""
         if DEBUG_LOCK:
             import random
 
             pseudouid = random.randint(1, 100)
             logging.debug(f"waiting for camera lock (pseudo id={pseudouid})")
 
+        if roi is None:
+            roi = {"x": 0, "y": 0, "width": SENSOR_WIDTH, "height": SENSOR_HEIGHT}
+
         async with self.camera_lock:
             if DEBUG_LOCK:
                 logging.debug(f"lock acquired (pseudo id={pseudouid})")
+            if not self.connected.is_set():  # connection might have been lost while waiting for lock
+                return
+
+            try:
+                hdul = await self._configure_and_expose(exposure, gain, color_mode, binning, roi, frame_type)
+            except Exception as e:
+                # e.g. vanished device; exposure timeouts are retried inside, so these errors are counted here
+                self._consecutive_device_errors += 1
+                if self._consecutive_device_errors > EXPOSURE_RETRIES:
+                    self.last_error = f"{self._consecutive_device_errors} consecutive device errors, last: {e}"
+                    self.connection_lost.set()
+                raise
+            self._consecutive_device_errors = 0
+            if DEBUG_LOCK:
+                logging.debug(f"releasing camera lock (pseudo id={pseudouid})")
+
+        if hdul is None:
+            self.last_error = f"{1 + EXPOSURE_RETRIES} consecutive exposures timed out"
+            self.connection_lost.set()
+            return
+        self.last_shot_time = datetime.utcnow()
+        header = hdul[0].header
+        if "XBINNING" not in header:
+            header["XBINNING"] = (binning, "binning factor")
+        header["XORGSUBF"] = (roi["x"], "subframe origin, in sensor pixels")
+        header["YORGSUBF"] = (roi["y"], "subframe origin, in sensor pixels")
+        callback(hdul)
+
+    async def _configure_and_expose(
+        self, exposure: float, gain: float, color_mode: str, binning: int, roi: Dict[str, int], frame_type: str
+    ) -> Optional[HDUList]:
+        """Device part of take_shot, must be run with camera lock acquired. None is returned if all exposures
+        timed out, device errors are raised"""
+        properties_changed = self._set_property_if_changed(  # specific values are hardcoded for ZWO camera
+            CCDSpecificProperties.CCD_MODE,
+            UserDefinedItem(
+                item_name=f"{'RGB 24' if color_mode == 'rgb' else 'RAW 8'} {binning}x{binning}",
+                item_value=True,
+            ),
+        )
+        if properties_changed:  # driver may adjust frame on mode change, so it is rewritten
+            self._applied_properties.pop(CCDSpecificProperties.CCD_FRAME.property_name, None)
+        properties_changed |= self._set_property_if_changed(
+            CCDSpecificProperties.CCD_FRAME, X=roi["x"], Y=roi["y"], WIDTH=roi["width"], HEIGHT=roi["height"]
+        )
+        properties_changed |= self._set_property_if_changed(CCDSpecificProperties.CCD_GAIN, GAIN=gain)
+        properties_changed |= self._set_property_if_changed(
+            CCDSpecificProperties.CCD_FRAME_TYPE, UserDefinedItem(item_name=frame_type, item_value=True)
+        )
+        if properties_changed:
+            await asyncio.sleep(0.1)  # safety sleep
+
+        for attempt in range(1 + EXPOSURE_RETRIES):
+            hdul = await self._expose(
+                exposure,
+                check=lambda hdul: self._image_mismatch(hdul, exposure, color_mode, binning, frame_type),
+            )
+            if hdul is not None:
+                return hdul
+            logging.warning(f"Exposure timed out (attempt {attempt + 1} of {1 + EXPOSURE_RETRIES})")
+        return None
+
+    def _set_property_if_changed(self, prop, *items, **item_values) -> bool:
+        """Set device property unless the same values were already written since connection.
+        Return whether the property was actually written"""
+        values = (
+            tuple((item.item_name, item.item_value) for item in items),
+            tuple(sorted(item_values.items())),
+        )
+        if self._applied_properties.get(prop.property_name) == values:
+            return False
+        self.device.set_property(prop, *items, **item_values)
+        self._applied_properties[prop.property_name] = values
+        return True
+
+    async def _expose(self, exposure: float, check: Callable[[HDUList], Optional[str]]) -> Optional[HDUList]:
+        """Start exposure and wait for resulting image, None is returned on timeout.
+
+        Timed out exposure is aborted, but its image may still arrive later and trigger callbacks of the following
+        exposures. So callbacks of finished exposures ignore images, and images failing the check (returning
+        mismatch description) are discarded while waiting for the right one."""
+        result = self.loop.create_future()
+
+        def wait_for_image():
+            async def get_exposure_results(action: IndigoDriverAction, prop: IndigoProperty):
+                if result.done():  # callback left from timed out exposure
+                    return
+                try:
+                    hdul = fitsutils.fits_bytes_to_hdu_list(prop.items[0].value)
+                    mismatch = check(hdul)
+                except Exception as e:
+                    mismatch = f"unreadable image ({e})"
+                if mismatch is None:
+                    result.set_result(hdul)
+                else:
+                    logging.warning(f"Discarding image not matching requested exposure: {mismatch}")
+                    wait_for_image()
+
             self.device.callback(
                 get_exposure_results,
                 accepts={
@@ -158,26 +385,44 @@ class CameraAdapter:
                 loop=self.loop,
             )
 
-            self.device.set_property(  # specific values are hardcoded for ZWO camera
-                CCDSpecificProperties.CCD_MODE,
-                UserDefinedItem(
-                    item_name="RAW 8 1x1" if color_mode == "greyscale" else "RGB 24 1x1",
-                    item_value=True,
-                ),
-            )
-            self.device.set_property(CCDSpecificProperties.CCD_GAIN, GAIN=gain)
-            time.sleep(0.1)  # safety sleep
-            self.device.set_property(CCDSpecificProperties.CCD_EXPOSURE, EXPOSURE=exposure)
-            await exposure_done.wait()
-            image_prop = exposure_result["prop"]
-            callback(fitsutils.fits_bytes_to_hdu_list(image_prop.items[0].value))
-            if DEBUG_LOCK:
-                logging.debug(f"releasing camera lock (pseudo id={pseudouid})")
+        wait_for_image()
+        self.device.set_property(CCDSpecificProperties.CCD_EXPOSURE, EXPOSURE=exposure)
+        try:
+            return await asyncio.wait_for(result, timeout=exposure + EXPOSURE_TIMEOUT_MARGIN)
+        except asyncio.TimeoutError:
+            try:
+                abort = UserDefinedItem(item_name="ABORT_EXPOSURE", item_value=True)
+                self.device.set_property(CCDSpecificProperties.CCD_ABORT_EXPOSURE, abort)
+            except Exception:
+                logging.exception("Unable to abort timed out exposure")
+            return None
+
+    @staticmethod
+    def _image_mismatch(
+        hdul: HDUList, exposure: float, color_mode: str, binning: int, frame_type: str
+    ) -> Optional[str]:
+        """Description of the difference between received image and requested settings, None if it matches"""
+        header = hdul[0].header
+        if abs(float(header.get("EXPTIME", exposure)) - exposure) > max(1e-3, 1e-3 * exposure):
+            return f"exposure {header['EXPTIME']} sec instead of {exposure} sec"
+        if (hdul[0].data.ndim == 3) != (color_mode == "rgb"):
+            return f"{hdul[0].data.ndim}-dimensional data for {color_mode} color mode"
+        if int(header.get("XBINNING", binning)) != binning:
+            return f"binning {header['XBINNING']} instead of {binning}"
+        if str(header.get("IMAGETYP", frame_type)).strip().lower() != frame_type.lower():
+            return f"{header['IMAGETYP']} frame instead of {frame_type.lower()}"
+        return None
 
     def _preview_generation_callback(self, hdul: HDUList):
         logging.debug("generating preview image...")
+        self._subtract_dark(hdul, ShotType.PREVIEW)
         inmem_file = BytesIO()
-        fitsutils.save_fits_as_jpeg(hdul, inmem_file)
+        preview_config = camera_config[ShotType.PREVIEW]
+        if preview_config.get("color_mode", "rgb").lower() == "bayer":
+            debayer_method = preview_config.get("debayer", "bilinear")
+        else:
+            debayer_method = None
+        fitsutils.save_fits_as_jpeg(hdul, inmem_file, debayer_method=debayer_method)
         inmem_file.seek(0)
         self.preview = inmem_file.getvalue()
         self.preview_metadata = fitsutils.extract_metadata(hdul)
@@ -201,8 +446,9 @@ class CameraAdapter:
             yield self.preview, self.preview_metadata
 
     def _fits_saving_callback(self, hdul: HDUList):
-        file_path = str(FITS_DIR / self._generate_image_name("image", "fits"))
+        file_path = FITS_DIR / self._generate_image_name("image", "fits")
         logging.debug(f"saving FITS image to {file_path}...")
+        self._subtract_dark(hdul, ShotType.SAVE_TO_DISK)
         environment = EnvironmentalConditionsReadingProtocol.current_measurements_as_dict(
             key_style="fits", include_timestamp=False
         )
@@ -215,6 +461,31 @@ class CameraAdapter:
                     f"Could not convert value {value} to float before writing it to FITS header, written as string"
                 )
         hdul.writeto(file_path)
+        if self.on_fits_saved is not None:
+            self.on_fits_saved(file_path)
+
+    def _dark_shot_settings(self, darks_config: Dict) -> Dict:
+        """Darks are taken in turn with settings of light scenarios, so that there are matching master darks"""
+        scenarios = [ShotType(name) for name in darks_config.get("scenarios", ["preview", "savetodisk"])]
+        self._dark_scenario_index = (self._dark_scenario_index + 1) % len(scenarios)
+        return camera_config[scenarios[self._dark_scenario_index]]
+
+    def _dark_frame_callback(self, hdul: HDUList):
+        # median-combining is too heavy to be done in event loop
+        def add_dark_frame():
+            try:
+                self.dark_library.add_dark_frame(hdul)
+            except Exception:
+                logging.exception("Unable to add dark frame to dark library")
+
+        self.loop.run_in_executor(None, add_dark_frame)
+
+    def _subtract_dark(self, hdul: HDUList, shot_type: ShotType):
+        if not camera_config[shot_type].get("subtract_dark", True):
+            return
+        master_dark = self.dark_library.subtract_dark(hdul)
+        if master_dark is not None:
+            logging.debug(f"master dark {master_dark} subtracted")
 
     @staticmethod
     def _saving_fits_is_enabled(config_entry):
@@ -1,17 +1,30 @@
+import os
 from pathlib import Path
 from enum import Enum
 import yaml
 
+from typing import Any, Optional
+
 import logging
 
 from watchgod import awatch
 from dictdiffer import diff
 
+from utils.debayer import DEBAYER_METHODS
+
+import read_dotenv  # noqa
+
 
 CONFIG_PATH = Path(__file__).parent / "../camconfig.yaml"
 
 camera_config = dict()
 
+# full frame is restored with these values when scenario has no ROI, default is ZWO ASI120MC-S sensor size
+SENSOR_WIDTH = int(os.environ.get("CAMERA_SENSOR_WIDTH", 1280))
+SENSOR_HEIGHT = int(os.environ.get("CAMERA_SENSOR_HEIGHT", 960))
+VALID_BINNINGS = (1, 2, 4)  # CCD_MODE items of ZWO camera
+COLOR_MODES = ("rgb", "greyscale", "bayer")
+
 
 class ShotType(Enum):
     """Keys from camconfig.yaml"""
@@ -19,11 +32,39 @@ class ShotType(Enum):
     PREVIEW = "preview"
     SAVE_TO_DISK = "savetodisk"
     TESTING = "testing"
+    DARKS = "darks"
 
     def __str__(self):
         return self.value
 
 
+def scenario_error(shot_type_config: Any) -> Optional[str]:
+    """Description of invalid values sent to device or used per shot in scenario config, None if they are valid"""
+    if not isinstance(shot_type_config, dict):
+        return None
+    color_mode = shot_type_config.get("color_mode", "rgb")
+    if not isinstance(color_mode, str) or color_mode.lower() not in COLOR_MODES:
+        return f"color_mode must be one of {', '.join(COLOR_MODES)}, not {color_mode}"
+    debayer = shot_type_config.get("debayer", DEBAYER_METHODS[0])
+    if debayer not in DEBAYER_METHODS:
+        return f"debayer must be one of {', '.join(DEBAYER_METHODS)}, not {debayer}"
+    binning = shot_type_config.get("binning", 1)
+    # bool is a subclass of int, and True == 1
+    if isinstance(binning, bool) or not isinstance(binning, int) or binning not in VALID_BINNINGS:
+        return f"binning must be one of {', '.join(str(b) for b in VALID_BINNINGS)}, not {binning}"
+    roi = shot_type_config.get("roi", None)
+    if roi is not None:
+        try:
+            x, y, width, height = (roi[key] for key in ("x", "y", "width", "height"))
+        except (TypeError, KeyError):
+            return f"roi must have x, y, width and height fields, not {roi}"
+        if not all(isinstance(value, int) and not isinstance(value, bool) for value in (x, y, width, height)):
+            return f"roi values must be integer, not {roi}"
+        if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > SENSOR_WIDTH or y + height > SENSOR_HEIGHT:
+            return f"roi {roi} does not fit in {SENSOR_WIDTH}x{SENSOR_HEIGHT} sensor"
+    return None
+
+
 def update_config(verbose: bool):
     with open(CONFIG_PATH, "r") as f:
         try:
@@ -35,12 +76,17 @@ def update_config(verbose: bool):
         for raw_key, shot_type_config in raw_new_config.items():
             try:
                 shot_type = ShotType(raw_key)
-                new_config[shot_type] = shot_type_config
             except ValueError:
                 logging.exception(
                     f'Invalid shot type name "{raw_key}" in camconfig.yaml, ignoring! '
                     + f'Valid shot type names are {", ".join(str(shot_type) for shot_type in list(ShotType))}'
                 )
+                continue
+            error = scenario_error(shot_type_config)
+            if error is not None:
+                logging.warning(f'Invalid "{raw_key}" scenario in camconfig.yaml, ignoring: {error}')
+                continue
+            new_config[shot_type] = shot_type_config
     if verbose:
         config_diff = diff(camera_config, new_config)
         try:
@@ -0,0 +1,191 @@
+import os
+import json
+import threading
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from pathlib import Path
+
+from typing import Dict, List, Optional
+
+import numpy as np
+from nptyping import NDArray
+from astropy.io.fits import HDUList
+
+from pyindigo import logging
+
+import read_dotenv  # noqa
+
+
+DARKS_DIR = Path(__file__).parent.parent / "calibration" / "darks"
+
+DARK_FRAMES_PER_MASTER = int(os.environ.get("DARK_FRAMES_PER_MASTER", 9))
+DARK_TEMPERATURE_BIN = float(os.environ.get("DARK_TEMPERATURE_BIN", 2))  # deg C
+DARK_MAX_TEMPERATURE_DIFFERENCE = float(os.environ.get("DARK_MAX_TEMPERATURE_DIFFERENCE", 6))  # deg C
+
+MEDIAN_CHUNK_ROWS = 64  # rows of frames stack processed at once when median-combining
+
+
+@dataclass
+class DarkKey:
+    """Master darks are matched to frames by these values. Frame shape encodes ROI size and color mode, but
+    the same shape may come from different sensor regions (e.g. 2x2 binned full frame and 640x480 ROI), while
+    amp glow and hot pixels depend on the position on the sensor, so binning and ROI origin are also kept"""
+
+    shape: List[int]
+    dtype: str
+    binning: int
+    origin: List[int]  # x, y of ROI in sensor pixels
+    exposure: float
+    gain: float
+    temperature: Optional[float]  # center of temperature bin, None if camera does not report temperature
+
+    @classmethod
+    def from_hdul(cls, hdul: HDUList) -> "DarkKey":
+        header = hdul[0].header
+        temperature = header.get("CCD-TEMP", None)
+        if temperature is not None:
+            temperature = round(float(temperature) / DARK_TEMPERATURE_BIN) * DARK_TEMPERATURE_BIN
+        return cls(
+            shape=list(hdul[0].data.shape),
+            dtype=hdul[0].data.dtype.newbyteorder("=").str,
+            binning=int(header.get("XBINNING", 1)),
+            origin=[int(header.get("XORGSUBF", 0)), int(header.get("YORGSUBF", 0))],
+            exposure=float(header.get("EXPTIME", 0)),
+            gain=float(header.get("GAIN", 0)),
+            temperature=temperature,
+        )
+
+    @property
+    def name(self) -> str:
+        temperature = "none" if self.temperature is None else f"{self.temperature:g}"
+        return (
+            f"dark_{'x'.join(str(dim) for dim in self.shape)}_{self.dtype.lstrip('<>=|')}"
+            + f"_bin{self.binning}_at{self.origin[0]}x{self.origin[1]}"
+            + f"_exp{self.exposure:g}_gain{self.gain:g}_temp{temperature}"
+        )
+
+    def matches(self, other: "DarkKey") -> bool:
+        """Whether darks with this key can be subtracted from frames with other key, regardless of temperature"""
+        return (
+            self.shape == other.shape
+            and self.dtype == other.dtype
+            and self.binning == other.binning
+            and self.origin == other.origin
+            and abs(self.exposure - other.exposure) < 1e-6
+            and abs(self.gain - other.gain) < 1e-6
+        )
+
+
+class DarkLibrary:
+    """Master darks, built from dark frames and subtracted from light frames.
+
+    Dark frames are streamed into memory-mapped stack files, one per DarkKey; when a stack is full it is
+    median-combined chunk by chunk into master dark, stored as .npy and memory-mapped for subtraction.
+    Adding frames is blocking and should be done in executor, subtraction is fast enough to be done inline."""
+
+    def __init__(self, darks_dir: Path = DARKS_DIR):
+        self.darks_dir = darks_dir
+        self.darks_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()  # held while adding frames, possibly for a long time
+        self.masters_lock = threading.Lock()  # held briefly to access masters from both worker and event loop
+        self._stack_sizes: Dict[str, int] = dict()  # key name -> frames accumulated so far
+        self._masters: Dict[str, DarkKey] = dict()
+        self._loaded_masters: Dict[str, NDArray] = dict()
+        self._buffers: Dict[tuple, NDArray] = dict()
+
+        for stale_stack in self.darks_dir.glob("*.stack.npy"):  # unfinished stacks from previous runs
+            stale_stack.unlink()
+        for index_file in self.darks_dir.glob("*.json"):
+            with open(index_file) as f:
+                try:
+                    key = DarkKey(**json.load(f)["key"])
+                except TypeError:
+                    logging.warning(f"Master dark index {index_file.name} has outdated format, ignoring it")
+                    continue
+            if (self.darks_dir / f"{key.name}.npy").exists():
+                self._masters[key.name] = key
+
+    def add_dark_frame(self, hdul: HDUList):
+        key = DarkKey.from_hdul(hdul)
+        data = hdul[0].data
+        with self.lock:
+            stack_file = self.darks_dir / f"{key.name}.stack.npy"
+            index = self._stack_sizes.get(key.name, 0)
+            mode = "r+" if index else "w+"
+            stack = np.lib.format.open_memmap(
+                stack_file, mode=mode, dtype=key.dtype, shape=(DARK_FRAMES_PER_MASTER, *key.shape)
+            )
+            stack[index] = data
+            stack.flush()
+            self._stack_sizes[key.name] = index + 1
+            logging.debug(f"dark frame {index + 1} of {DARK_FRAMES_PER_MASTER} added to {key.name}")
+            if index + 1 < DARK_FRAMES_PER_MASTER:
+                return
+            self._combine_stack(key, stack)
+            del stack
+            stack_file.unlink()
+            del self._stack_sizes[key.name]
+
+    def _combine_stack(self, key: DarkKey, stack: NDArray):
+        """Median-combine stack into master dark without loading the whole stack into memory"""
+        master_file = self.darks_dir / f"{key.name}.npy"
+        temp_file = self.darks_dir / f"{key.name}.tmp.npy"
+        master = np.lib.format.open_memmap(temp_file, mode="w+", dtype=key.dtype, shape=tuple(key.shape))
+        rows_axis = 0 if len(key.shape) == 2 else 1  # color frames are shaped (3, height, width)
+        for start in range(0, key.shape[rows_axis], MEDIAN_CHUNK_ROWS):
+            rows = slice(start, start + MEDIAN_CHUNK_ROWS)
+            chunk = stack[:, rows] if rows_axis == 0 else stack[:, :, rows]
+            median = np.median(chunk, axis=0)
+            if rows_axis == 0:
+                master[rows] = median
+            else:
+                master[:, rows] = median
+        master.flush()
+        del master
+        with open(self.darks_dir / f"{key.name}.json", "w") as f:
+            json.dump({"key": asdict(key), "created_utc": datetime.utcnow().isoformat()}, f, indent=4)
+        with self.masters_lock:
+            os.replace(temp_file, master_file)
+            self._loaded_masters.pop(key.name, None)  # previous master with this key is not used anymore
+            self._masters[key.name] = key
+        logging.info(f"Master dark {key.name} is ready")
+
+    def nearest_master(self, key: DarkKey) -> Optional[str]:
+        """Name of the master dark matching frame key with the closest temperature"""
+        with self.masters_lock:
+            masters = list(self._masters.values())
+        candidates = [master for master in masters if master.matches(key)]
+        if key.temperature is not None:
+            candidates = [
+                master
+                for master in candidates
+                if master.temperature is not None
+                and abs(master.temperature - key.temperature) <= DARK_MAX_TEMPERATURE_DIFFERENCE
+            ]
+            candidates.sort(key=lambda master: abs(master.temperature - key.temperature))
+        return candidates[0].name if candidates else None
+
+    def subtract_dark(self, hdul: HDUList) -> Optional[str]:
+        """Subtract nearest master dark from frame in-place (clipping at zero for unsigned data), name of
+        subtracted master dark is added to the header. Returns the name, or None if no master matches"""
+        data = hdul[0].data
+        name = self.nearest_master(DarkKey.from_hdul(hdul))
+        if name is None:
+            return None
+        with self.masters_lock:  # so that master file is not replaced between loading and caching it
+            master = self._loaded_masters.get(name)
+            if master is None:
+                master = np.load(self.darks_dir / f"{name}.npy", mmap_mode="r")
+                self._loaded_masters[name] = master
+
+        if data.dtype.kind == "u":
+            buffer = self._buffers.get((data.shape, data.dtype))
+            if buffer is None:
+                buffer = np.empty_like(data)
+                self._buffers[(data.shape, data.dtype)] = buffer
+            np.minimum(data, master, out=buffer)
+            data -= buffer
+        else:
+            data -= master
+        hdul[0].header["DARKSUB"] = (name, "master dark subtracted")
+        return name
@@ -0,0 +1,148 @@
+import os
+import sys
+import asyncio
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from types import FrameType
+
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from pyindigo import logging
+
+import read_dotenv  # noqa
+
+
+DIAGNOSTICS_TOKEN = os.environ.get("DIAGNOSTICS_TOKEN", "")  # diagnostics endpoints are disabled if not set
+LOOP_LAG_SAMPLE_INTERVAL = float(os.environ.get("LOOP_LAG_SAMPLE_INTERVAL", 0.1))  # sec
+SLOW_CALLBACK_THRESHOLD = float(os.environ.get("SLOW_CALLBACK_THRESHOLD", 0.25))  # sec
+
+LAG_SAMPLES_KEPT = 3000  # 5 minutes with default interval
+SLOW_CALLBACKS_KEPT = 50
+MAX_PROFILE_DURATION = 60  # sec
+MIN_PROFILE_INTERVAL = 0.001  # sec, more frequent sampling would itself stall the loop by holding the GIL
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _stack_labels(frame: Optional[FrameType]) -> List[str]:
+    """Frame labels from outermost to innermost"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return labels[::-1]
+
+
+def _culprit(frame: FrameType) -> str:
+    """Callback or coroutine run by event loop in given stack: the frame right above asyncio's Handle._run"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    for outer, inner in zip(frames, frames[1:]):
+        if outer.f_code.co_name == "_run" and outer.f_code.co_filename.endswith(os.path.join("asyncio", "events.py")):
+            return _frame_label(inner)
+    return _frame_label(frames[-1])
+
+
+class LoopMonitor:
+    """Event loop lag sampler and slow callback detector.
+
+    A coroutine wakes up every LOOP_LAG_SAMPLE_INTERVAL and records how late it is. A watchdog thread checks
+    that these wake-ups happen; if the loop is stuck for longer than SLOW_CALLBACK_THRESHOLD, stack of the
+    loop thread is captured, pointing to the blocking callback or coroutine step"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.lags = deque(maxlen=LAG_SAMPLES_KEPT)
+        self.slow_callbacks = deque(maxlen=SLOW_CALLBACKS_KEPT)
+        self.loop_thread_id: Optional[int] = None
+        self._heartbeat = time.monotonic()
+        self._current_stall: Optional[Dict[str, Any]] = None
+        self._stall_heartbeat = 0.0  # last heartbeat before current stall
+
+    def start(self):
+        self.loop.create_task(self._sample_lag())
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+
+    async def _sample_lag(self):
+        self._heartbeat = time.monotonic()
+        self.loop_thread_id = threading.get_ident()
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_SAMPLE_INTERVAL)
+            self._heartbeat = now = time.monotonic()
+            self.lags.append(now - start - LOOP_LAG_SAMPLE_INTERVAL)
+
+    def _watchdog(self):
+        while True:
+            time.sleep(SLOW_CALLBACK_THRESHOLD / 2)
+            if self.loop_thread_id is None:
+                continue
+            stalled_for = time.monotonic() - self._heartbeat - LOOP_LAG_SAMPLE_INTERVAL
+            if stalled_for > SLOW_CALLBACK_THRESHOLD and self._current_stall is None:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is None:
+                    continue
+                self._stall_heartbeat = self._heartbeat
+                self._current_stall = {
+                    "detected_utc": datetime.utcnow().isoformat(),
+                    "culprit": _culprit(frame),
+                    "stack": _stack_labels(frame),
+                    "duration": None,  # set when loop is unblocked
+                }
+                del frame
+                self.slow_callbacks.append(self._current_stall)
+                logging.warning(f"Event loop is blocked by {self._current_stall['culprit']}")
+            elif self._current_stall is not None and self._heartbeat != self._stall_heartbeat:
+                duration = self._heartbeat - self._stall_heartbeat - LOOP_LAG_SAMPLE_INTERVAL
+                self._current_stall["duration"] = duration
+                logging.warning(f"Event loop was blocked by {self._current_stall['culprit']} for {duration:.2f} sec")
+                self._current_stall = None
+
+    def stats(self) -> Dict[str, Any]:
+        lags = np.array(self.lags) if self.lags else np.zeros(1)
+        p50, p90, p99 = np.percentile(lags, [50, 90, 99])
+        return {
+            "lag_seconds": {"p50": p50, "p90": p90, "p99": p99, "max": lags.max(), "samples": len(self.lags)},
+            "slow_callbacks": list(self.slow_callbacks),
+        }
+
+
+class SamplingProfiler:
+    """In-process sampling profiler, producing collapsed stacks (input format of flamegraph.pl, speedscope etc).
+    It is a plain thread polling interpreter frames, so it costs nothing when not running"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def profile(self, duration: float, interval: float, thread_ids: Optional[List[int]] = None) -> str:
+        """Blocking, sample given threads (all but the profiler's own if None) for duration seconds"""
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("Profiling is already in progress")
+        try:
+            own_thread_id = threading.get_ident()
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = Counter()
+            end = time.monotonic() + min(duration, MAX_PROFILE_DURATION)
+            interval = max(interval, MIN_PROFILE_INTERVAL)
+            while time.monotonic() < end:
+                frames = sys._current_frames()
+                for thread_id, frame in frames.items():
+                    if thread_id == own_thread_id or (thread_ids is not None and thread_id not in thread_ids):
+                        continue
+                    thread_name = thread_names.get(thread_id, str(thread_id))
+                    stacks[";".join([thread_name] + _stack_labels(frame))] += 1
+                del frames, frame  # not keeping frames of other threads alive
+                time.sleep(interval)
+            return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        finally:
+            self.lock.release()
@@ -1,5 +1,6 @@
 from .celestial import get_celestial_observation_conditions
 from .environmental import EnvironmentalConditionsReadingProtocol, run_environmental_conditions_monitor
+from .history import ObservationConditionsHistory
 
 
 def get_observation_conditions():
@@ -11,5 +12,6 @@ def get_observation_conditions():
 
 __all__ = [
     'run_environmental_conditions_monitor',
+    'ObservationConditionsHistory',
     'get_obsevation_conditions'
 ]
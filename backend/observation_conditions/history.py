@@ -0,0 +1,331 @@
+import os
+import gzip
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from nptyping import NDArray
+
+import logging
+
+from .environmental import LOGS_DIR
+
+
+CACHE_VERSION = 1
+MEMORY_CACHED_DAYS = 7  # tables of other days are reloaded from .npz cache when queried
+
+
+def column_key(tsv_column: str) -> str:
+    """TSV column name to measurement name (i.e. JSON key), see MeasurementSet.as_dict"""
+    name = tsv_column.rsplit(", ", maxsplit=1)[0]
+    return name.strip().lower().replace(" ", "_")
+
+
+def _to_float(values: List[str]) -> NDArray:
+    """Vectorized conversion of string values to float, missing and malformed values become NaN"""
+    array = np.array(values, dtype=object)
+    array[array == ""] = "nan"
+    try:
+        return array.astype(np.float64)
+    except ValueError:
+        result = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                result[i] = float(value)
+            except ValueError:
+                pass
+        return result
+
+
+def _to_unix_time(timestamps: List[str]) -> NDArray:
+    """Timestamps as written by EnvironmentalConditionsReadingProtocol (str of naive UTC datetime)"""
+    return np.array(timestamps, dtype="datetime64[us]").astype(np.int64) / 1e6
+
+
+@dataclass
+class ConditionsTable:
+    """Columnar representation of observation conditions: timestamps (UTC unix time) and value columns"""
+
+    timestamps: NDArray
+    columns: Dict[str, NDArray]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def select(self, mask_or_slice) -> "ConditionsTable":
+        return ConditionsTable(
+            self.timestamps[mask_or_slice], {key: column[mask_or_slice] for key, column in self.columns.items()}
+        )
+
+    @classmethod
+    def concatenate(cls, tables: Iterable["ConditionsTable"], columns: Optional[List[str]] = None):
+        """Concatenate tables with possibly different columns, missing values are filled with NaN"""
+        tables = [table for table in tables if len(table)]
+        if columns is None:
+            columns = list(dict.fromkeys(key for table in tables for key in table.columns))
+        if not tables:
+            return cls(np.empty(0), {key: np.empty(0) for key in columns})
+        return cls(
+            np.concatenate([table.timestamps for table in tables]),
+            {
+                key: np.concatenate([table.columns.get(key, np.full(len(table), np.nan)) for table in tables])
+                for key in columns
+            },
+        )
+
+
+def parse_tsv_lines(lines: List[str], header: List[str]) -> ConditionsTable:
+    rows = [line.split("\t") for line in lines if line.strip()]
+    rows = [row for row in rows if len(row) == len(header)]  # skipping malformed lines
+    if not rows:
+        return ConditionsTable(np.empty(0), {column_key(name): np.empty(0) for name in header if name != "timestamp"})
+    values_by_column = list(zip(*rows))
+    timestamps = None
+    columns = dict()
+    for name, values in zip(header, values_by_column):
+        if name == "timestamp":
+            timestamps = _to_unix_time(values)
+        else:
+            columns[column_key(name)] = _to_float(values)
+    return ConditionsTable(timestamps, columns)
+
+
+class DailyLog:
+    """Single day TSV log with .npz cache stored next to it.
+
+    Cache is invalidated by source file's size and mtime. Growing plain .tsv file (today's log) is not
+    re-parsed from scratch: only lines appended since the previous parsing are."""
+
+    def __init__(self, source: Path):
+        self.source = source
+        self.cache_file = source.parent / (source.name.split(".")[0] + ".npz")
+
+    def load(self) -> ConditionsTable:
+        source_stat = self.source.stat()
+        cache = self._load_cache()
+        if cache is not None and cache["source_name"] == self.source.name:
+            if cache["source_size"] == source_stat.st_size and cache["source_mtime_ns"] == source_stat.st_mtime_ns:
+                return cache["table"]
+            if not self._is_gzipped and source_stat.st_size > cache["parsed_bytes"]:
+                tail, parsed_bytes = self._parse(offset=cache["parsed_bytes"], header=cache["header"])
+                table = ConditionsTable.concatenate([cache["table"], tail])
+                self._save_cache(table, cache["header"], parsed_bytes, source_stat)
+                return table
+        table, parsed_bytes, header = self._parse_from_scratch()
+        self._save_cache(table, header, parsed_bytes, source_stat)
+        return table
+
+    @property
+    def _is_gzipped(self) -> bool:
+        return self.source.suffix == ".gz"
+
+    def _parse_from_scratch(self):
+        opener = gzip.open if self._is_gzipped else open
+        with opener(self.source, "rb") as f:
+            content = f.read()
+        header_end = content.index(b"\n") + 1
+        header = content[:header_end].decode().strip().split("\t")
+        table, parsed_bytes = self._parse_content(content, header_end, header)
+        return table, parsed_bytes, header
+
+    def _parse(self, offset: int, header: List[str]):
+        with open(self.source, "rb") as f:
+            f.seek(offset)
+            content = f.read()
+        table, parsed_bytes = self._parse_content(content, 0, header)
+        return table, offset + parsed_bytes
+
+    @staticmethod
+    def _parse_content(content: bytes, start: int, header: List[str]):
+        end = content.rfind(b"\n") + 1  # last line might be incomplete if it is being written right now
+        if end <= start:
+            return parse_tsv_lines([], header), start
+        lines = content[start:end].decode(errors="replace").split("\n")
+        return parse_tsv_lines(lines, header), end
+
+    def _load_cache(self) -> Optional[Dict]:
+        try:
+            with np.load(self.cache_file, allow_pickle=False) as npz:
+                if int(npz["version"]) != CACHE_VERSION:
+                    return None
+                column_keys = [str(key) for key in npz["column_keys"]]
+                return {
+                    "source_name": str(npz["source_name"]),
+                    "source_size": int(npz["source_size"]),
+                    "source_mtime_ns": int(npz["source_mtime_ns"]),
+                    "parsed_bytes": int(npz["parsed_bytes"]),
+                    "header": [str(name) for name in npz["header"]],
+                    "table": ConditionsTable(
+                        npz["timestamps"], {key: npz[f"column_{i}"] for i, key in enumerate(column_keys)}
+                    ),
+                }
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Unable to read observation conditions cache {self.cache_file}, ignoring. Details: {e}")
+            return None
+
+    def _save_cache(self, table: ConditionsTable, header: List[str], parsed_bytes: int, source_stat: os.stat_result):
+        # unique temp file, as logs may be cached concurrently, e.g. by reprocess.py workers
+        fd, temp_file = tempfile.mkstemp(dir=self.cache_file.parent, prefix=f"{self.cache_file.stem}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    version=CACHE_VERSION,
+                    source_name=self.source.name,
+                    source_size=source_stat.st_size,
+                    source_mtime_ns=source_stat.st_mtime_ns,
+                    parsed_bytes=parsed_bytes,
+                    header=np.array(header),
+                    column_keys=np.array(list(table.columns.keys())),
+                    timestamps=table.timestamps,
+                    **{f"column_{i}": column for i, column in enumerate(table.columns.values())},
+                )
+            os.replace(temp_file, self.cache_file)
+        except OSError as e:
+            logging.warning(f"Unable to write observation conditions cache {self.cache_file}. Details: {e}")
+            try:
+                os.unlink(temp_file)
+            except OSError:
+                pass
+
+
+class ObservationConditionsHistory:
+    """Range and aggregate queries over daily observation conditions logs"""
+
+    def __init__(self, logs_dir: Path = LOGS_DIR):
+        self.logs_dir = logs_dir
+        # source -> (size, mtime, table), LRU of recently queried days, saves loading .npz every query
+        self._tables: "OrderedDict[Path, tuple]" = OrderedDict()
+        self._lock = threading.Lock()  # queries are run from worker threads
+
+    def day_table(self, day: date) -> Optional[ConditionsTable]:
+        with self._lock:
+            return self._day_table(day)
+
+    def _day_table(self, day: date) -> Optional[ConditionsTable]:
+        stem = f'obs_conditions_{day.strftime(r"%Y_%m_%d")}'
+        for source in (self.logs_dir / f"{stem}.tsv", self.logs_dir / f"{stem}.tsv.gz"):
+            try:
+                source_stat = source.stat()
+            except FileNotFoundError:
+                continue
+            cached = self._tables.get(source)
+            if cached is not None and cached[:2] == (source_stat.st_size, source_stat.st_mtime_ns):
+                self._tables.move_to_end(source)
+                return cached[2]
+            table = DailyLog(source).load()
+            self._tables[source] = (source_stat.st_size, source_stat.st_mtime_ns, table)
+            self._tables.move_to_end(source)
+            while len(self._tables) > MEMORY_CACHED_DAYS:
+                self._tables.popitem(last=False)
+            return table
+        return None
+
+    def query(self, start: datetime, end: datetime, columns: Optional[List[str]] = None) -> ConditionsTable:
+        """All measurements in [start, end) time range (naive datetimes are UTC)"""
+        start, end = _naive_utc(start), _naive_utc(end)  # daily logs are named by UTC date
+        tables = []
+        day = start.date()
+        while day <= end.date():
+            table = self.day_table(day)
+            if table is not None:
+                tables.append(table)
+            day += timedelta(days=1)
+        table = ConditionsTable.concatenate(tables, columns)
+        start_ts, end_ts = _unix_time(start), _unix_time(end)
+        return table.select(slice(*np.searchsorted(table.timestamps, [start_ts, end_ts])))
+
+    def aggregate(
+        self, start: datetime, end: datetime, bin_seconds: float = 3600, columns: Optional[List[str]] = None
+    ) -> Dict[str, NDArray]:
+        """Mean, min, max and count of non-missing values for each column in time bins starting from start.
+        Empty bins are omitted. Result has 'bin_start' array (UTC unix time) and '<column>_<stat>' arrays"""
+        if not bin_seconds > 0:
+            raise ValueError(f"bin size must be positive, not {bin_seconds}")
+        table = self.query(start, end, columns)
+        bins = ((table.timestamps - _unix_time(start)) // bin_seconds).astype(np.int64)
+        bin_ids, bin_starts = np.unique(bins, return_index=True)
+        result = {"bin_start": _unix_time(start) + bin_ids * bin_seconds}
+        if not len(table):
+            for key in table.columns:
+                for stat in ("mean", "min", "max", "count"):
+                    result[f"{key}_{stat}"] = np.empty(0)
+            return result
+        for key, column in table.columns.items():
+            present = ~np.isnan(column)
+            count = np.add.reduceat(present.astype(np.int64), bin_starts)
+            total = np.add.reduceat(np.where(present, column, 0), bin_starts)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result[f"{key}_mean"] = total / count
+            result[f"{key}_min"] = np.fmin.reduceat(column, bin_starts)
+            result[f"{key}_max"] = np.fmax.reduceat(column, bin_starts)
+            result[f"{key}_count"] = count
+        return result
+
+    def value_at(self, time: datetime, columns: Optional[List[str]] = None) -> Dict[str, float]:
+        """Latest measurement done at or before given time, looking back no further than a day"""
+        time = _naive_utc(time)
+        for day in (time.date(), time.date() - timedelta(days=1)):
+            table = self.day_table(day)
+            if table is None:
+                continue
+            index = np.searchsorted(table.timestamps, _unix_time(time), side="right") - 1
+            if index < 0:
+                continue
+            keys = table.columns.keys() if columns is None else columns
+            result = {"timestamp": float(table.timestamps[index])}
+            for key in keys:
+                result[key] = float(table.columns[key][index]) if key in table.columns else float("nan")
+            return result
+        return dict()
+
+
+def _naive_utc(dt: datetime) -> datetime:
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _unix_time(dt: datetime) -> float:
+    if dt.tzinfo is not None:
+        return dt.timestamp()
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Query observation conditions logs")
+    parser.add_argument("--from", dest="start", type=datetime.fromisoformat, help="UTC, ISO format")
+    parser.add_argument("--to", dest="end", type=datetime.fromisoformat, help="UTC, ISO format")
+    parser.add_argument("--at", type=datetime.fromisoformat, help="UTC, ISO format; print latest values at given time")
+    parser.add_argument("--columns", type=lambda s: s.split(","), default=None, help="comma-separated, default all")
+    parser.add_argument("--aggregate", type=float, default=None, help="bin size in seconds, e.g. 3600 for hourly")
+    parser.add_argument("--logs-dir", type=Path, default=LOGS_DIR)
+    args = parser.parse_args()
+
+    history = ObservationConditionsHistory(args.logs_dir)
+    if args.at is not None:
+        for key, value in history.value_at(args.at, args.columns).items():
+            print(f"{key}\t{value}")
+        sys.exit(0)
+    if args.start is None or args.end is None:
+        parser.error("either --at or both --from and --to must be specified")
+
+    if args.aggregate is not None:
+        result = history.aggregate(args.start, args.end, args.aggregate, args.columns)
+    else:
+        table = history.query(args.start, args.end, args.columns)
+        result = {"timestamp": table.timestamps, **table.columns}
+    print("\t".join(result.keys()))
+    for row in zip(*result.values()):
+        print("\t".join([str(datetime.utcfromtimestamp(row[0]))] + [f"{value:g}" for value in row[1:]]))
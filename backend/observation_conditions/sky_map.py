@@ -0,0 +1,187 @@
+import json
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from math import pi, sin, cos, tan, radians
+from pathlib import Path
+
+from typing import Dict, Optional, Tuple
+
+import ephem
+import numpy as np
+from nptyping import NDArray
+
+from .celestial import sit
+
+
+CALIBRATION_DIR = Path(__file__).parent.parent.parent / "calibration"
+SKY_MAP_FILE = CALIBRATION_DIR / "sky_map.npy"
+
+# layers of sky map array
+ALTITUDE, AZIMUTH, EAST, NORTH, UP = range(5)
+
+# zenith angle -> distance from optical center relative to the distance for 90 degrees, and inverse
+PROJECTIONS = {
+    "equidistant": (lambda theta: theta / (pi / 2), lambda rho: rho * (pi / 2)),
+    "equisolid": (lambda theta: np.sin(theta / 2) / sin(pi / 4), lambda rho: 2 * np.arcsin(rho * sin(pi / 4))),
+    "stereographic": (lambda theta: np.tan(theta / 2) / tan(pi / 4), lambda rho: 2 * np.arctan(rho * tan(pi / 4))),
+    "orthographic": (lambda theta: np.sin(theta), lambda rho: np.arcsin(rho)),
+}
+
+
+@dataclass
+class LensCalibration:
+    """All-sky camera lens model and orientation, in unbinned sensor pixels"""
+
+    width: int
+    height: int
+    center_x: float  # optical center, i.e. zenith position
+    center_y: float
+    horizon_radius: float  # distance from center to horizon
+    north_angle: float = 0  # deg, position of north in the image, clockwise from image top
+    mirrored: bool = True  # True if east is counter-clockwise from north, as on sky charts
+    projection: str = "equidistant"
+
+    def pixel_to_horizontal(self, x: NDArray, y: NDArray) -> Tuple[NDArray, NDArray]:
+        """Altitude and azimuth (rad) of pixels; NaN for pixels outside lens projection domain"""
+        dx = x - self.center_x
+        dy = self.center_y - y  # image rows grow downwards
+        with np.errstate(invalid="ignore"):
+            zenith_angle = PROJECTIONS[self.projection][1](np.hypot(dx, dy) / self.horizon_radius)
+        image_angle = np.arctan2(dx, dy) - radians(self.north_angle)
+        azimuth = np.mod(-image_angle if self.mirrored else image_angle, 2 * pi)
+        return pi / 2 - zenith_angle, azimuth
+
+    def horizontal_to_pixel(self, altitude: float, azimuth: float) -> Tuple[float, float]:
+        rho = float(PROJECTIONS[self.projection][0](pi / 2 - altitude)) * self.horizon_radius
+        image_angle = (-azimuth if self.mirrored else azimuth) + radians(self.north_angle)
+        return self.center_x + rho * sin(image_angle), self.center_y - rho * cos(image_angle)
+
+
+def build_sky_map(calibration: LensCalibration, path: Path = SKY_MAP_FILE):
+    """Compute per-pixel altitude, azimuth and horizontal unit vectors and store them as .npy file
+    (shaped 5 x height x width, float32) with calibration .json file next to it"""
+    y, x = np.mgrid[0:calibration.height, 0:calibration.width].astype(np.float64)
+    altitude, azimuth = calibration.pixel_to_horizontal(x, y)
+    path.parent.mkdir(exist_ok=True)
+    sky_map = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(5, calibration.height, calibration.width)
+    )
+    sky_map[ALTITUDE] = altitude
+    sky_map[AZIMUTH] = azimuth
+    sky_map[EAST] = np.cos(altitude) * np.sin(azimuth)
+    sky_map[NORTH] = np.cos(altitude) * np.cos(azimuth)
+    sky_map[UP] = np.sin(altitude)
+    sky_map.flush()
+    with open(path.with_suffix(".json"), "w") as f:
+        json.dump(asdict(calibration), f, indent=4)
+
+
+def _unit_vector(altitude: float, azimuth: float) -> NDArray:
+    return np.array([cos(altitude) * sin(azimuth), cos(altitude) * cos(azimuth), sin(altitude)], dtype=np.float32)
+
+
+class SkyMap:
+    """Pixel-to-sky lookup for the all-sky camera, backed by memory-mapped precomputed array.
+
+    Masks are computed with comparisons and dot products on precomputed layers only, so per-frame cost
+    is O(pixels) without trigonometry. Use for_frame to get view matching binned and/or ROI frames."""
+
+    def __init__(
+        self, layers: NDArray, calibration: LensCalibration, binning: int = 1, origin: Tuple[int, int] = (0, 0)
+    ):
+        self.layers = layers
+        self.calibration = calibration
+        self.binning = binning
+        self.origin = origin  # of the frame, in sensor pixels
+        self._horizon_masks: Dict[float, NDArray] = dict()
+
+    @classmethod
+    def load(cls, path: Path = SKY_MAP_FILE) -> "SkyMap":
+        with open(path.with_suffix(".json")) as f:
+            calibration = LensCalibration(**json.load(f))
+        return cls(np.load(path, mmap_mode="r"), calibration)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.layers.shape[1:]
+
+    @property
+    def altitude(self) -> NDArray:
+        return self.layers[ALTITUDE]
+
+    @property
+    def azimuth(self) -> NDArray:
+        return self.layers[AZIMUTH]
+
+    def for_frame(self, binning: int = 1, roi: Optional[Dict[str, int]] = None) -> "SkyMap":
+        """View for frames taken with given binning and ROI (as in camconfig.yaml). Each binned pixel
+        is represented by the sensor pixel nearest to its center"""
+        x, y = (roi["x"], roi["y"]) if roi else (0, 0)
+        height, width = (roi["height"], roi["width"]) if roi else self.shape
+        offset = (binning - 1) // 2
+        layers = self.layers[:, y + offset:y + height:binning, x + offset:x + width:binning]
+        return SkyMap(layers[:, :height // binning, :width // binning], self.calibration, binning, (x, y))
+
+    def horizon_mask(self, min_altitude: float = 0) -> NDArray:
+        """Mask of pixels above given altitude (deg); cached, as it is the same for every frame"""
+        if min_altitude not in self._horizon_masks:
+            with np.errstate(invalid="ignore"):
+                self._horizon_masks[min_altitude] = self.altitude > radians(min_altitude)
+        return self._horizon_masks[min_altitude]
+
+    def zenith_mask(self, max_zenith_angle: float) -> NDArray:
+        return self.horizon_mask(90 - max_zenith_angle)
+
+    def proximity_mask(self, altitude: float, azimuth: float, radius: float) -> NDArray:
+        """Mask of pixels within radius (deg) from given direction (altitude and azimuth in rad)"""
+        direction = _unit_vector(altitude, azimuth)
+        cosine = direction[0] * self.layers[EAST]
+        cosine += direction[1] * self.layers[NORTH]
+        cosine += direction[2] * self.layers[UP]
+        return cosine > cos(radians(radius))
+
+    def moon_mask(self, when: datetime, radius: float = 10) -> NDArray:
+        """Mask of pixels within radius (deg) from the Moon at given UTC datetime"""
+        return self.proximity_mask(*body_position(ephem.Moon(), when), radius)
+
+    def pixel_of(self, altitude: float, azimuth: float) -> Optional[Tuple[int, int]]:
+        """(x, y) of frame pixel in given direction (rad), None if it is outside the frame"""
+        x, y = self.calibration.horizontal_to_pixel(altitude, azimuth)
+        x, y = int((x - self.origin[0]) // self.binning), int((y - self.origin[1]) // self.binning)
+        height, width = self.shape
+        if not (0 <= x < width and 0 <= y < height):
+            return None
+        return x, y
+
+    def moon_pixel(self, when: datetime) -> Optional[Tuple[int, int]]:
+        altitude, azimuth = body_position(ephem.Moon(), when)
+        return self.pixel_of(altitude, azimuth) if altitude > 0 else None
+
+
+def body_position(body: ephem.Body, when: datetime) -> Tuple[float, float]:
+    """Apparent altitude and azimuth (rad) of celestial body for SIT at given UTC datetime"""
+    observer = sit.copy()  # shared observer is modified by get_celestial_observation_conditions
+    observer.date = ephem.Date(when)
+    body.compute(observer)
+    return float(body.alt), float(body.az)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build pixel-to-sky map for all-sky camera")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=960)
+    parser.add_argument("--center-x", type=float, required=True)
+    parser.add_argument("--center-y", type=float, required=True)
+    parser.add_argument("--horizon-radius", type=float, required=True)
+    parser.add_argument("--north-angle", type=float, default=0)
+    parser.add_argument("--not-mirrored", dest="mirrored", action="store_false")
+    parser.add_argument("--projection", choices=list(PROJECTIONS.keys()), default="equidistant")
+    parser.add_argument("--output", type=Path, default=SKY_MAP_FILE)
+    args = parser.parse_args()
+
+    output = args.output
+    del args.output
+    build_sky_map(LensCalibration(**vars(args)), output)
+    print(f"Sky map saved to {output}")
@@ -0,0 +1,261 @@
+"""Offline batch reprocessing of archived FITS frames.
+
+Selected frames are split into chunks, processed by a pipeline of stages in a process pool, and recorded
+in a checkpoint file, so that an interrupted run can be resumed. Run from backend directory, e.g.
+
+    python reprocess.py --from 2021-11-01 --to 2021-11-30 --stages rehead,thumbnail,stats
+    python reprocess.py --glob "image_2021_11_2*" --stages compress --workers 8
+"""
+
+import os
+import argparse
+import fnmatch
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from astropy.io import fits
+
+import utils.fits as fitsutils
+from archive.retention import fits_shot_time
+from archive.thumbnails import render_thumbnail
+from observation_conditions.environmental import Measurement, MeasurementSet
+from observation_conditions.history import ObservationConditionsHistory
+from observation_conditions.sky_map import SkyMap, SKY_MAP_FILE
+
+
+IMAGES_DIR = Path(__file__).parent.parent / "images"
+STAGES = ("rehead", "thumbnail", "stats", "compress")  # compress renames files, so it is always run last
+STATS_COLUMNS = ("name", "shot_utc", "pixels", "mean", "median", "std", "min", "max")
+
+
+def archive_key(path: Path) -> str:
+    """Frame name regardless of compression, used in checkpoints"""
+    return path.name[:-3] if path.name.endswith(".fz") else path.name
+
+
+def utc_datetime(value: str) -> datetime:
+    """ISO format argument as naive UTC datetime, comparable to shot times from file names"""
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def select_frames(
+    images_dir: Path, start: Optional[datetime], end: Optional[datetime], pattern: Optional[str]
+) -> List[Path]:
+    """Archived frames with shot time in [start, end) and name matching glob pattern, in time order"""
+    frames = []
+    with os.scandir(images_dir) as entries:
+        for entry in entries:
+            shot_time = fits_shot_time(entry.name)
+            if shot_time is None:
+                continue
+            if (start is not None and shot_time < start) or (end is not None and shot_time >= end):
+                continue
+            if pattern is not None and not fnmatch.fnmatch(entry.name, pattern):
+                continue
+            frames.append((shot_time, Path(entry.path)))
+    return [path for _, path in sorted(frames)]
+
+
+# stages, run in worker processes
+
+
+class Pipeline:
+    """Per-process pipeline state: history and sky map caches are reused across chunks"""
+
+    _instance: Optional["Pipeline"] = None
+
+    def __init__(self, options: Dict):
+        self.options = options
+        self.history = ObservationConditionsHistory(Path(options["logs_dir"])) if options["logs_dir"] else None
+        sky_map_file = Path(options["sky_map"])
+        self.sky_map = SkyMap.load(sky_map_file) if sky_map_file.exists() else None
+
+    @classmethod
+    def get(cls, options: Dict) -> "Pipeline":
+        if cls._instance is None or cls._instance.options != options:
+            cls._instance = cls(options)
+        return cls._instance
+
+    def rehead(self, path: Path, hdu_index: int) -> Optional[Dict]:
+        """Write environmental conditions at shot time from TSV logs to FITS header"""
+        shot_time = fits_shot_time(path.name)
+        values = self.history.value_at(shot_time)
+        if not values:
+            return None
+        timestamp = datetime.utcfromtimestamp(values.pop("timestamp"))
+        if (shot_time - timestamp).total_seconds() > self.options["max_environment_age"]:
+            return None
+        measurements = [Measurement(key, value, "") for key, value in values.items() if not np.isnan(value)]
+        environment = MeasurementSet(measurements, timestamp).as_dict(key_style="fits", include_timestamp=True)
+        with fits.open(path, mode="update") as hdul:
+            hdul[hdu_index].header.update(environment)
+        return None
+
+    def thumbnail(self, path: Path, hdu_index: int) -> Optional[Dict]:
+        thumbnail_file = Path(self.options["output_dir"]) / "thumbnails" / f"{archive_key(path)}.jpg"
+        thumbnail_file.write_bytes(
+            render_thumbnail(path, self.options["thumbnail_size"], self.options["stretch"], self.options["debayer"])
+        )
+        return None
+
+    def stats(self, path: Path, hdu_index: int) -> Optional[Dict]:
+        """Frame statistics in zenith region (whole frame if no sky map is available)"""
+        image_data, header = fitsutils.read_image(path)
+        image_data = image_data.astype(np.float32)
+        if image_data.ndim == 3:
+            image_data = image_data.mean(axis=0)  # luminance-like
+        if self.sky_map is not None:
+            sky_map = self.sky_map.for_frame(binning=int(header.get("XBINNING", 1)))
+            if sky_map.shape == image_data.shape:
+                image_data = image_data[sky_map.zenith_mask(self.options["zenith_angle"])]
+        values = image_data.ravel()
+        return {
+            "name": archive_key(path),
+            "shot_utc": str(fits_shot_time(path.name)),
+            "pixels": values.size,
+            "mean": float(values.mean()),
+            "median": float(np.median(values)),
+            "std": float(values.std()),
+            "min": float(values.min()),
+            "max": float(values.max()),
+        }
+
+    def compress(self, path: Path, hdu_index: int) -> Optional[Dict]:
+        if path.name.endswith(".fz"):
+            return None
+        temp_file = path.with_suffix(".fits.fz.tmp")
+        fitsutils.compress_fits(path, temp_file)
+        os.replace(temp_file, path.with_suffix(".fits.fz"))
+        path.unlink()
+        return None
+
+
+def process_chunk(paths: List[Path], stages: List[str], options: Dict) -> Tuple[List[str], List[Dict], List[str]]:
+    """Worker entry point; returns keys of processed frames, stats rows and error messages"""
+    pipeline = Pipeline.get(options)
+    done, rows, errors = [], [], []
+    for path in paths:
+        try:
+            hdu_index = 1 if path.name.endswith(".fz") else 0
+            for stage in stages:
+                row = getattr(pipeline, stage)(path, hdu_index)
+                if row is not None:
+                    rows.append(row)
+            done.append(archive_key(path))
+        except Exception as e:
+            errors.append(f"{path.name}: {e.__class__.__name__}: {e}")
+    return done, rows, errors
+
+
+# orchestration
+
+
+def chunks(paths: List[Path], chunk_size: int) -> Iterator[List[Path]]:
+    for start in range(0, len(paths), chunk_size):
+        yield paths[start:start + chunk_size]
+
+
+def reprocess(
+    paths: List[Path], stages: List[str], options: Dict, workers: int, chunk_size: int, checkpoint_file: Path
+):
+    output_dir = Path(options["output_dir"])
+    if "thumbnail" in stages:
+        (output_dir / "thumbnails").mkdir(parents=True, exist_ok=True)
+    stats_file = output_dir / "sky_stats.tsv"
+    if "stats" in stages and not stats_file.exists():
+        stats_file.write_text("\t".join(STATS_COLUMNS) + "\n")
+
+    total, processed, failed = len(paths), 0, 0
+    start_time = last_report_time = time.time()
+    chunk_iterator = chunks(paths, chunk_size)
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(checkpoint_file, "a") as checkpoint:
+        pending = set()
+        while True:
+            while len(pending) < 2 * workers:  # bounded number of chunks in flight, others are not materialized
+                chunk = next(chunk_iterator, None)
+                if chunk is None:
+                    break
+                pending.add(executor.submit(process_chunk, chunk, stages, options))
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done, rows, errors = future.result()
+                if rows:
+                    with open(stats_file, "a") as f:
+                        for row in rows:
+                            f.write("\t".join(str(row[column]) for column in STATS_COLUMNS) + "\n")
+                checkpoint.write("".join(f"{key}\n" for key in done))
+                checkpoint.flush()
+                for error in errors:
+                    print(f"ERROR {error}")
+                processed += len(done) + len(errors)
+                failed += len(errors)
+
+            now = time.time()
+            if now - last_report_time > 5 or not pending:
+                last_report_time = now
+                throughput = processed / (now - start_time)
+                eta = timedelta(seconds=int((total - processed) / throughput)) if throughput else "?"
+                print(f"{processed}/{total} frames ({failed} failed), {throughput:.1f} frames/s, ETA {eta}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch reprocessing of archived FITS frames")
+    parser.add_argument("--from", dest="start", type=utc_datetime, help="UTC if no offset, shot time lower bound")
+    parser.add_argument("--to", dest="end", type=utc_datetime, help="UTC if no offset, shot time upper bound")
+    parser.add_argument("--glob", default=None, help="file name pattern, e.g. 'image_2021_11_*'")
+    parser.add_argument("--stages", type=lambda s: s.split(","), required=True, help=f"any of {', '.join(STAGES)}")
+    parser.add_argument("--images-dir", type=Path, default=IMAGES_DIR)
+    parser.add_argument("--output-dir", type=Path, default=Path("reprocessed"))
+    parser.add_argument("--checkpoint", type=Path, default=None, help="default is per stages set, in output dir")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=32)
+    # stage options
+    parser.add_argument("--logs-dir", type=Path, default=None, help="observation conditions logs, for rehead")
+    parser.add_argument("--max-environment-age", type=float, default=60, help="sec, for rehead")
+    parser.add_argument("--thumbnail-size", type=int, default=256)
+    parser.add_argument("--stretch", default="minmax")
+    parser.add_argument("--debayer", default="superpixel")
+    parser.add_argument("--sky-map", type=Path, default=SKY_MAP_FILE, help="for stats")
+    parser.add_argument("--zenith-angle", type=float, default=60, help="deg, stats are computed within it")
+    args = parser.parse_args()
+
+    unknown_stages = set(args.stages) - set(STAGES)
+    if unknown_stages:
+        parser.error(f"unknown stages: {', '.join(unknown_stages)}")
+    stages = sorted(args.stages, key=lambda stage: stage == "compress")
+    if "rehead" in stages and args.logs_dir is None:
+        from observation_conditions.environmental import LOGS_DIR
+
+        args.logs_dir = LOGS_DIR
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint_file = args.checkpoint or args.output_dir / f"checkpoint_{'_'.join(stages)}.txt"
+    already_done = set(checkpoint_file.read_text().split()) if checkpoint_file.exists() else set()
+    paths = [
+        path
+        for path in select_frames(args.images_dir, args.start, args.end, args.glob)
+        if archive_key(path) not in already_done
+    ]
+    print(f"{len(paths)} frames to process ({len(already_done)} already done according to {checkpoint_file})")
+
+    options = {
+        "output_dir": str(args.output_dir),
+        "logs_dir": str(args.logs_dir) if args.logs_dir else None,
+        "max_environment_age": args.max_environment_age,
+        "thumbnail_size": args.thumbnail_size,
+        "stretch": args.stretch,
+        "debayer": args.debayer,
+        "sky_map": str(args.sky_map),
+        "zenith_angle": args.zenith_angle,
+    }
+    reprocess(paths, stages, options, args.workers, args.chunk_size, checkpoint_file)
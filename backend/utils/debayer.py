@@ -0,0 +1,93 @@
+import numpy as np
+from nptyping import NDArray
+
+from astropy.io.fits import Header
+
+from typing import Dict, List, Optional, Tuple
+
+
+BAYER_PATTERNS = ("RGGB", "BGGR", "GRBG", "GBRG")
+DEBAYER_METHODS = ("superpixel", "bilinear")
+
+
+def bayer_pattern(header: Header) -> Optional[str]:
+    """Bayer pattern of frame's top left corner from FITS header, None for non-Bayer frames"""
+    pattern = str(header.get("BAYERPAT", "")).strip().upper()
+    if pattern not in BAYER_PATTERNS:
+        return None
+    # pattern offsets, e.g. for odd ROI origin
+    x_offset = int(header.get("XBAYROFF", 0)) % 2
+    y_offset = int(header.get("YBAYROFF", 0)) % 2
+    rows = [pattern[:2], pattern[2:]]
+    if y_offset:
+        rows = rows[::-1]
+    if x_offset:
+        rows = [row[::-1] for row in rows]
+    return "".join(rows)
+
+
+def _channel_positions(pattern: str) -> Dict[str, List[Tuple[int, int]]]:
+    """Channel -> positions (row, column) inside 2x2 Bayer cell"""
+    positions = {"R": [], "G": [], "B": []}
+    for i, channel in enumerate(pattern):
+        positions[channel].append((i // 2, i % 2))
+    return positions
+
+
+def debayer_superpixel(raw: NDArray, pattern: str) -> NDArray:
+    """Each 2x2 Bayer cell becomes one RGB pixel, resulting in half resolution. The fastest method"""
+    raw = raw[:raw.shape[0] // 2 * 2, :raw.shape[1] // 2 * 2]
+    result = np.empty((3, raw.shape[0] // 2, raw.shape[1] // 2), dtype=np.float32)
+    for channel_index, channel in enumerate("RGB"):
+        positions = _channel_positions(pattern)[channel]
+        result[channel_index] = raw[positions[0][0]::2, positions[0][1]::2]
+        for row, column in positions[1:]:
+            result[channel_index] += raw[row::2, column::2]
+        result[channel_index] /= len(positions)
+    return result
+
+
+def debayer_bilinear(raw: NDArray, pattern: str) -> NDArray:
+    """Full resolution demosaicing, missing color values are averaged from nearest neighbours of that color.
+    Each of four Bayer cell positions is processed separately on quarter-sized strided views"""
+    raw = raw[:raw.shape[0] // 2 * 2, :raw.shape[1] // 2 * 2]
+    height, width = raw.shape
+    padded = np.pad(raw.astype(np.float32), 1, mode="reflect")  # reflection preserves Bayer parity
+
+    def neighbours(dy: int, dx: int, row: int, column: int) -> NDArray:
+        return padded[1 + dy + row:1 + dy + height:2, 1 + dx + column:1 + dx + width:2]
+
+    result = np.empty((3, height, width), dtype=np.float32)
+    channel_index = {"R": 0, "G": 1, "B": 2}
+    for i, channel in enumerate(pattern):
+        row, column = i // 2, i % 2
+        cell = (slice(row, None, 2), slice(column, None, 2))
+        result[(channel_index[channel],) + cell] = raw[cell]
+        horizontal = (neighbours(0, -1, row, column) + neighbours(0, 1, row, column)) / 2
+        vertical = (neighbours(-1, 0, row, column) + neighbours(1, 0, row, column)) / 2
+        if channel == "G":
+            horizontal_channel = pattern[i ^ 1]  # the other color in the same row
+            vertical_channel = "R" if horizontal_channel == "B" else "B"
+            result[(channel_index[horizontal_channel],) + cell] = horizontal
+            result[(channel_index[vertical_channel],) + cell] = vertical
+        else:
+            other_channel = "B" if channel == "R" else "R"
+            result[(channel_index["G"],) + cell] = (horizontal + vertical) / 2
+            result[(channel_index[other_channel],) + cell] = (
+                neighbours(-1, -1, row, column)
+                + neighbours(-1, 1, row, column)
+                + neighbours(1, -1, row, column)
+                + neighbours(1, 1, row, column)
+            ) / 4
+    return result
+
+
+def debayer(raw: NDArray, pattern: str, method: str = "bilinear") -> NDArray:
+    """Demosaic raw Bayer frame (e.g. captured in RAW 8 mode of color camera) into float32 color frame,
+    shaped (3, height, width) as color FITS frames are"""
+    if method == "superpixel":
+        return debayer_superpixel(raw, pattern)
+    elif method == "bilinear":
+        return debayer_bilinear(raw, pattern)
+    else:
+        raise ValueError(f"Unknown debayering method {method}. Options are {', '.join(DEBAYER_METHODS)}")
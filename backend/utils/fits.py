@@ -1,10 +1,15 @@
 import numpy as np
 from nptyping import NDArray
 
+from astropy.io import fits
 from astropy.io.fits import HDUList
 from PIL import Image
 
-from typing import Dict, Any
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
+
+from utils.debayer import bayer_pattern, debayer
 
 
 def normalize_frame(frame: NDArray, bits: int = 8) -> NDArray:
@@ -17,23 +22,60 @@ def normalize_frame(frame: NDArray, bits: int = 8) -> NDArray:
         return frame.astype("int8")
 
 
-def save_fits_as_jpeg(hdul: HDUList, filename: str):
-    image_data: NDArray = hdul[0].data.copy()
+def stretch_frame(frame: NDArray, low_percentile: float, high_percentile: float, bits: int = 8) -> NDArray:
+    """Linear stretch between given percentiles of frame values, values outside are clipped"""
+    frame = frame.astype(np.float32)
+    low, high = np.percentile(frame, [low_percentile, high_percentile])
+    if high <= low:
+        return normalize_frame(frame, bits)
+    frame = np.clip((frame - low) / (high - low), 0, 1)
+    return ((2 ** bits - 1) * frame).astype("uint8")
+
+
+def frame_to_image(image_data: NDArray, stretch: str = "minmax") -> Image.Image:
+    """Convert FITS frame data to 8 bit PIL image. Stretch options are 'minmax' and 'percentile'"""
     if image_data.ndim == 3:
         image_data = np.transpose(image_data, (1, 2, 0))
+    if stretch == "minmax":
         image_data = normalize_frame(image_data)
-        image = Image.fromarray(image_data, "RGB")
-    elif image_data.ndim == 2:
-        image_data = normalize_frame(image_data)
-        image = Image.fromarray(image_data, "L")
+    elif stretch == "percentile":
+        image_data = stretch_frame(image_data, low_percentile=0.5, high_percentile=99.5)
+    else:
+        raise ValueError(f"Unknown stretch {stretch}. Options are 'minmax' or 'percentile'!")
+    return Image.fromarray(image_data, "RGB" if image_data.ndim == 3 else "L")
+
+
+def debayered(image_data: NDArray, header: fits.Header, method: Optional[str]) -> NDArray:
+    """Color frame from raw Bayer one if header specifies Bayer pattern, other frames are returned as is"""
+    if method is None or image_data.ndim != 2:
+        return image_data
+    pattern = bayer_pattern(header)
+    if pattern is None:
+        return image_data
+    return debayer(image_data, pattern, method)
+
+
+def save_fits_as_jpeg(hdul: HDUList, filename: str, debayer_method: Optional[str] = None):
+    image_data = debayered(hdul[0].data.copy(), hdul[0].header, debayer_method)
+    image = frame_to_image(image_data)
     image.save(filename, format="jpeg")
 
 
+def read_image(path: Path) -> Tuple[NDArray, fits.Header]:
+    """Read image data and header from plain or tile-compressed (.fits.fz) FITS file"""
+    with fits.open(path) as hdul:
+        for hdu in hdul:
+            if hdu.is_image and hdu.data is not None:
+                return hdu.data.copy(), hdu.header.copy()
+    raise ValueError(f"No image data found in {path}")
+
+
 fits_fields_to_metadata_fields = {
     "EXPTIME": "exposure",
     "CCD-TEMP": "device_temperature",
     "GAIN": "gain",
     "DATE-OBS": "device_time",
+    "XBINNING": "binning",
 }
 
 
@@ -48,8 +90,20 @@ def extract_metadata(hdul: HDUList) -> Dict[str, Any]:
 def fits_bytes_to_hdu_list(fits_bytes: bytes) -> HDUList:
     if isinstance(fits_bytes, bytes):
         try:
-            return HDUList.fromstring(fits_bytes)
+            # unlike HDUList.fromstring, reading from file object gives writable data arrays
+            return fits.open(BytesIO(fits_bytes))
         except Exception:
             raise ValueError("Unable to convert bytes to HDUList object")
     else:
         raise TypeError(f"Expected bytes as an argument, got {fits_bytes.__class__.__name__}")
+
+
+def compress_fits(source: Path, destination: Path):
+    """Losslessly compress FITS image into tile-compressed .fits.fz (fpack-compatible) file"""
+    with fits.open(source) as hdul:
+        data = hdul[0].data
+        if data.dtype.kind in "iu":
+            compressed = fits.CompImageHDU(data, hdul[0].header, compression_type="RICE_1")
+        else:  # RICE_1 quantizes floating point data, only unquantized GZIP is lossless for it
+            compressed = fits.CompImageHDU(data, hdul[0].header, compression_type="GZIP_2", quantize_level=0.0)
+        fits.HDUList([fits.PrimaryHDU(), compressed]).writeto(destination, overwrite=True)
@@ -0,0 +1,41 @@
+"""Measure in-place master dark subtraction cost for full frames, compared to the shortest shot period (preview).
+
+Run from repository root: python experiments/dark_subtraction_benchmark.py
+"""
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+import dark_library  # noqa
+
+
+WIDTH, HEIGHT = 1280, 960  # ZWO ASI120MC-S full frame
+PREVIEW_PERIOD = 5  # sec, see camconfig.yaml.example
+REPEATS = 50
+
+
+def frame(shape, rng) -> fits.HDUList:
+    header = fits.Header({"EXPTIME": 3.0, "GAIN": 1, "CCD-TEMP": 12.3})
+    return fits.HDUList([fits.PrimaryHDU(rng.integers(0, 256, shape, dtype=np.uint8), header=header)])
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    library = dark_library.DarkLibrary(Path(tempfile.mkdtemp()))
+    print(f"{'frame':<12}{'subtraction, ms':>18}{'of preview period':>20}")
+    for name, shape in [("RAW 8", (HEIGHT, WIDTH)), ("RGB 24", (3, HEIGHT, WIDTH))]:
+        for _ in range(dark_library.DARK_FRAMES_PER_MASTER):
+            library.add_dark_frame(frame(shape, rng))
+        hduls = [frame(shape, rng) for _ in range(REPEATS)]
+        start = time.perf_counter()
+        for hdul in hduls:
+            assert library.subtract_dark(hdul) is not None
+        duration = (time.perf_counter() - start) / REPEATS
+        print(f"{name:<12}{1000 * duration:>18.2f}{duration / PREVIEW_PERIOD:>20.3%}")
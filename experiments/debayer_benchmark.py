@@ -0,0 +1,49 @@
+"""Compare preview generation from full-frame RGB 24 capture with RAW 8 capture + debayering on the server.
+
+Payload is FITS file size as transferred from INDIGO driver; time includes FITS decoding and JPEG encoding.
+Run from repository root: python experiments/debayer_benchmark.py
+"""
+
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+sys.path.append(str(Path(__file__).parent.parent / "backend"))
+
+import utils.fits as fitsutils  # noqa
+
+
+WIDTH, HEIGHT = 1280, 960  # ZWO ASI120MC-S full frame
+REPEATS = 20
+
+
+def fits_bytes(data: np.ndarray, header: dict) -> bytes:
+    inmem_file = BytesIO()
+    fits.PrimaryHDU(data, header=fits.Header(header)).writeto(inmem_file)
+    return inmem_file.getvalue()
+
+
+def benchmark(payload: bytes, debayer_method: str = None) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        hdul = fitsutils.fits_bytes_to_hdu_list(payload)
+        fitsutils.save_fits_as_jpeg(hdul, BytesIO(), debayer_method=debayer_method)
+    return (time.perf_counter() - start) / REPEATS
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    rgb24 = fits_bytes(rng.integers(0, 256, (3, HEIGHT, WIDTH), dtype=np.uint8), {})
+    raw8 = fits_bytes(rng.integers(0, 256, (HEIGHT, WIDTH), dtype=np.uint8), {"BAYERPAT": "RGGB"})
+
+    print(f"{'capture':<28}{'payload, MB':>12}{'preview, ms':>14}")
+    for name, payload, debayer_method in [
+        ("RGB 24", rgb24, None),
+        ("RAW 8 + superpixel", raw8, "superpixel"),
+        ("RAW 8 + bilinear", raw8, "bilinear"),
+    ]:
+        print(f"{name:<28}{len(payload) / 1024 ** 2:>12.2f}{1000 * benchmark(payload, debayer_method):>14.1f}")